@@ -0,0 +1,217 @@
+"""
+Benchmarks for the slow parts of the tools.
+
+"""
+from pathlib import Path
+import csv
+import io
+import subprocess
+import sys
+import time
+
+import config
+
+
+# Modules that each task imports when it runs, on top of tasks.py itself.
+TASK_IMPORTS = {
+    'show_users': [],
+    'send_email': ['util', 'orders'],
+    'download_orders_awaiting_shipment': ['orders'],
+    'generate_report': ['arrow', 'util'],
+    'write_packing_info_to_labels': ['orders', 'packinginfo'],
+    'print_tracking_numbers': ['trackingnumber.extractor'],
+    'web': ['web2'],
+}
+
+STARTUP_BENCH_FILE = 'startup_bench.csv'
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import tasks
+{imports}
+print(time.perf_counter() - start)
+"""
+
+
+def bench_startup(runs=5):
+    """
+    Measure how long it takes to import tasks.py plus the modules of each
+    task, each in a fresh interpreter. The best time of each task is printed
+    next to the previous run and appended to ORDERS_DIR/startup_bench.csv.
+
+    """
+    bench_file = Path(config.ORDERS_DIR) / STARTUP_BENCH_FILE
+    previous = read_previous_startup_times(bench_file)
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+    rows = []
+
+    for task, modules in TASK_IMPORTS.items():
+        script = IMPORT_SCRIPT.format(
+            imports='\n'.join('import ' + m for m in modules))
+        times = []
+        for _ in range(runs):
+            proc = subprocess.run(
+                [sys.executable, '-c', script],
+                cwd=str(Path(__file__).parent),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if proc.returncode != 0:
+                error = proc.stderr.decode('utf-8').strip().splitlines()[-1]
+                print('{:<36} failed: {}'.format(task, error))
+                break
+            times.append(float(proc.stdout))
+        else:
+            best = min(times)
+            rows.append((timestamp, task, '{:.4f}'.format(best)))
+            before = previous.get(task)
+            change = '' if before is None else \
+                '(was {:.1f} ms)'.format(before * 1000)
+            print('{:<36} {:7.1f} ms {}'.format(task, best * 1000, change))
+
+    is_new = not bench_file.exists()
+    with bench_file.open('a', newline='') as fp:
+        writer = csv.writer(fp)
+        if is_new:
+            writer.writerow(['time', 'task', 'seconds'])
+        writer.writerows(rows)
+
+
+def read_previous_startup_times(bench_file):
+    "Return the most recently recorded import time of each task."
+    result = {}
+    if bench_file.exists():
+        with bench_file.open() as fp:
+            for row in csv.DictReader(fp):
+                result[row['task']] = float(row['seconds'])
+    return result
+
+
+def bench_extractor_backends(dir_path='.', runs=3):
+    """
+    Extract tracking numbers from the label PDFs in dir_path with each
+    extraction backend, and print the best time of each backend and the pages
+    where the backends disagree.
+
+    """
+    from trackingnumber.backends import BACKENDS
+    from trackingnumber.extractor import (
+        TrackingNumberExtractor, get_tracking_numbers_for_page)
+
+    pdf_files = TrackingNumberExtractor(dir_path).input_files
+    results = {}
+
+    for name, backend_class in BACKENDS.items():
+        times = []
+        for _ in range(runs):
+            backend = backend_class()
+            pages = []
+            start = time.perf_counter()
+            for pdf_file in pdf_files:
+                for i, words in enumerate(backend.get_pages(pdf_file), 1):
+                    pages.append(list(get_tracking_numbers_for_page(
+                        words, str(pdf_file), i)))
+            times.append(time.perf_counter() - start)
+
+        results[name] = [
+            sorted((tn.type, tn.value) for tn in page) for page in pages]
+        label_count = sum(len(page) for page in pages)
+        fallbacks = getattr(backend, 'fallback_count', None)
+        print('{:<10} {:8.1f} ms  {} pages, {} labels{}'.format(
+            name, min(times) * 1000, len(pages), label_count,
+            '' if fallbacks is None else
+            ', {} pages fell back to pdftotext'.format(fallbacks)))
+
+    names = list(results)
+    reference = results[names[0]]
+    for name in names[1:]:
+        pages = results[name]
+        if len(pages) != len(reference):
+            print('{} found {} pages but {} found {}'.format(
+                name, len(pages), names[0], len(reference)))
+            continue
+        for i, (expected, actual) in enumerate(zip(reference, pages), 1):
+            if expected != actual:
+                print('Page {}: {} found {}, {} found {}'.format(
+                    i, names[0], expected, name, actual))
+
+
+def bench_overlay_rendering(label_counts=(50, 500, 5000), runs=3):
+    """
+    Compare rendering the packing info overlays one PDF per page against
+    rendering them all into a single PDF, for batches of each size in
+    label_counts. Each page gets the same kind of overlay as a real label.
+
+    """
+    from packinginfo import (
+        OutputMeta, get_center_line, get_page_number, get_username,
+        render_output_page, render_output_pages)
+
+    for label_count in label_counts:
+        pages = [
+            [OutputMeta.get_output_info(
+                'single-domestic', '2x ABC-{}-12 A3, DEF-{} B7'.format(i, i)),
+             get_username('user{}'.format(i % 3)),
+             get_page_number(i, label_count, label_count),
+             get_center_line()]
+            for i in range(1, label_count + 1)
+        ]
+        modes = [
+            ('per page', lambda: [render_output_page(p) for p in pages]),
+            ('single', lambda: render_output_pages(pages)),
+        ]
+        for name, render in modes:
+            times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                render()
+                times.append(time.perf_counter() - start)
+            best = min(times)
+            print('{:>5} labels  {:<9} {:9.1f} ms  {:6.2f} ms/label'.format(
+                label_count, name, best * 1000, best * 1000 / label_count))
+
+
+def bench_page_normalization(dir_path='.', runs=3):
+    """
+    Compare the two ways of making half-size label pages full size: merging
+    the page into a blank page, and wrapping its content stream in a form
+    XObject. Every page gets an overlay merged on top, as in
+    PackingInfoWriter, and the time and output size of each are printed.
+
+    """
+    from PyPDF2 import PdfFileReader, PdfFileWriter
+    from packinginfo import get_page_number, render_output_page
+    from pdfutil import (
+        get_full_size_page, is_half_size_page, merge_full_size_page)
+    from trackingnumber.extractor import TrackingNumberExtractor
+
+    pdf_files = TrackingNumberExtractor(dir_path).input_files
+    overlay = render_output_page([get_page_number(1, 1, 1)])
+    methods = [
+        ('merge', merge_full_size_page),
+        ('form', get_full_size_page),
+    ]
+
+    for name, normalize in methods:
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            writer = PdfFileWriter()
+            half_count = 0
+            for pdf_file in pdf_files:
+                # Read each file again, since normalizing changes the pages.
+                reader = PdfFileReader(
+                    io.BytesIO(pdf_file.read_bytes()), strict=False)
+                for page_index in range(reader.numPages):
+                    page = reader.getPage(page_index)
+                    if is_half_size_page(page):
+                        page = normalize(page)
+                        half_count += 1
+                    page.mergePage(overlay)
+                    writer.addPage(page)
+
+            buf = io.BytesIO()
+            writer.write(buf)
+            times.append(time.perf_counter() - start)
+
+        print('{:<6} {:8.1f} ms  {:8.1f} KB  ({} half-size pages)'.format(
+            name, min(times) * 1000, len(buf.getvalue()) / 1024, half_count))
@@ -7,3 +7,5 @@ REPORT_URL = ''
 TIME_ZONE = 'US/Central'
 GDRIVE_FOLDER = 'Shipping Label Inbox'
 BACKUP_PATH = Path(__file__).parent.parent / 'ebay-backup/items'
+# Also keep downloaded orders in an indexed SQLite database in ORDERS_DIR.
+USE_ORDER_STORE = False
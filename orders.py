@@ -3,12 +3,17 @@ Check for orders that have been paid but have not been shipped.
 
 """
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import json
 import itertools
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 
 import arrow
-from ebaysdk.trading import Connection as Trading
-from ebaysdk.shopping import Connection as Shopping
 
 import config
 import util
@@ -18,106 +23,562 @@ from logger import log
 SHIPPING_URL_TEMPLATE = 'https://payments.ebay.com/ws/eBayISAPI.dll?PrintPostage&transactionid={transaction_id}&ssPageName=STRK:MESO:PSHP&itemid={item_id}'
 SHIPPING_URL_TEMPLATE_2 = 'https://payments.ebay.com/ws/eBayISAPI.dll?PrintPostage&orderId={order_id}'
 DAYS_BACK = 10
-
-
-def download_orders_awaiting_shipment():
+# Number of days back that orders awaiting shipment and shipped orders cover.
+RECENT_DAYS_BACK = 2
+# Maximum number of seller accounts to download at the same time.
+MAX_WORKERS = 4
+# Stores the time of the last successful incremental sync of each account.
+SYNC_STATE_FILE = 'sync_state.json'
+# Suffix of the pickle snapshots of loaded orders.
+SNAPSHOT_SUFFIX = '.snapshot'
+# Change this whenever the enriched orders change shape, so that old snapshots
+# are rebuilt.
+SNAPSHOT_VERSION = 1
+# The order fields that this app reads. Projected downloads only ask for these.
+ORDER_FIELDS = [
+    'OrderID',
+    'OrderStatus',
+    'BuyerUserID',
+    'BuyerCheckoutMessage',
+    'AmountPaid',
+    'CreatedTime',
+    'PaidTime',
+    'ShippedTime',
+    'ShippingAddress.Name',
+    'ShippingAddress.Street1',
+    'ShippingAddress.Street2',
+    'ShippingAddress.CityName',
+    'ShippingAddress.StateOrProvince',
+    'ShippingAddress.PostalCode',
+    'ShippingAddress.CountryName',
+    'TransactionArray.Transaction.Item.ItemID',
+    'TransactionArray.Transaction.Item.Title',
+    'TransactionArray.Transaction.QuantityPurchased',
+    'TransactionArray.Transaction.ShippingDetails.ShipmentTrackingDetails.ShipmentTrackingNumber',
+]
+# Fields needed to page through GetOrders responses.
+PAGINATION_FIELDS = [
+    'PaginationResult',
+    'PageNumber',
+    'ReturnedOrderCountActual',
+]
+
+
+def download_orders_awaiting_shipment(**kwargs):
     """
-    Download orders awaiting shipment.
+    Download orders awaiting shipment. See download_orders() for the keyword
+    arguments.
 
     """
-    download_orders('orders.json', 'get_orders_awaiting_shipment')
+    download_orders('orders.json', 'get_orders_awaiting_shipment', **kwargs)
 
 
-def download_shipped_orders(output_file='shipped_orders.json'):
+def download_shipped_orders(output_file='shipped_orders.json', **kwargs):
     """
     Download orders that have been marked as shipped (i.e. their shipping labels
-    have been printed).
+    have been printed). See download_orders() for the keyword arguments.
 
     """
-    download_orders(output_file, 'get_shipped_orders')
+    download_orders(output_file, 'get_shipped_orders', **kwargs)
+
+
+def download_orders(output_file, method, concurrent=False,
+                    max_workers=MAX_WORKERS, page_concurrency=None,
+                    incremental=False, projected=False):
+    """
+    Download orders for every account in config.EBAY_CREDENTIALS and write them
+    to output_file.
+
+    If concurrent is True, the accounts are downloaded in parallel on a pool of
+    at most max_workers threads. An account that fails is logged and recorded
+    under the 'failures' key, and the other accounts are still written.
+
+    page_concurrency is passed on to each OrderRequest.
 
+    If incremental is True, only orders modified since the last successful sync
+    of each account are requested and merged into the existing output_file.
 
-def download_orders(output_file, method):
-    order_count = 0
+    If projected is True, only the fields in ORDER_FIELDS are downloaded, and
+    that list is written to the file under the 'schema' key.
+
+    If config.USE_ORDER_STORE is True, the download is also written to the
+    order store.
+
+    """
+    orders_file = Path(config.ORDERS_DIR) / output_file
     result = dict(payload={})
 
-    for user_id, cred in config.EBAY_CREDENTIALS.items():
-        request = OrderRequest(cred)
-        get_orders = getattr(request, method)
-        orders = list(get_orders())
-        result['payload'][user_id] = orders
-        order_count += len(orders)
+    if incremental:
+        sync = IncrementalSync(
+            orders_file, method, page_concurrency, projected)
+        download = sync.download_account
+    else:
+        def download(user_id, cred):
+            return download_account(cred, method, page_concurrency, projected)
+
+    if concurrent:
+        downloads = download_accounts_concurrently(download, max_workers)
+        failures = {}
+        for user_id, (orders, error) in downloads.items():
+            if error is None:
+                result['payload'][user_id] = orders
+            else:
+                failures[user_id] = error
+                if incremental and user_id in sync.payload:
+                    # Keep the orders from the last sync for this account.
+                    result['payload'][user_id] = sync.payload[user_id]
+        if failures:
+            result['failures'] = failures
+    else:
+        for user_id, cred in config.EBAY_CREDENTIALS.items():
+            result['payload'][user_id] = download(user_id, cred)
 
+    order_count = sum(len(orders) for orders in result['payload'].values())
     result['download_time'] = arrow.utcnow().format()
+    if projected:
+        result['schema'] = ORDER_FIELDS
 
-    orders_file = Path(config.ORDERS_DIR) / output_file
     with orders_file.open('w') as fp:
         json.dump(result, fp, indent=2)
 
+    if incremental:
+        sync.save_state()
+
+    if config.USE_ORDER_STORE:
+        from orderstore import OrderStore
+        store = OrderStore()
+        try:
+            store.write_download(output_file, result)
+        finally:
+            store.close()
+
     log('Downloaded {} orders to {}'.format(order_count, orders_file))
 
 
-def load_orders(json_file):
+def download_account(cred, method, page_concurrency=None, projected=False):
+    "Return the list of orders for a single account."
+    request = OrderRequest(
+        cred, page_concurrency=page_concurrency, projected=projected)
+    get_orders = getattr(request, method)
+    return list(get_orders())
+
+
+def download_accounts_concurrently(download, max_workers=MAX_WORKERS):
+    """
+    Call download(user_id, cred) for all accounts on a thread pool. Return an
+    ordered dict that maps each user ID to a (orders, error) tuple, where error
+    is None on success.
+
+    """
+    def run(user_id, cred):
+        start = time.time()
+        try:
+            orders = download(user_id, cred)
+        except Exception as ex:
+            log('{}: download failed after {:.1f}s: {!r}'.format(
+                user_id, time.time() - start, ex))
+            return None, repr(ex)
+
+        log('{}: downloaded {} orders in {:.1f}s'.format(
+            user_id, len(orders), time.time() - start))
+        return orders, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            (user_id, executor.submit(run, user_id, cred))
+            for user_id, cred in config.EBAY_CREDENTIALS.items()
+        ]
+        # Collect results in config order so the payload order is stable.
+        return OrderedDict(
+            (user_id, future.result()) for user_id, future in futures)
+
+
+class IncrementalSync:
+    """
+    Keeps a per-account high-water mark of the last successful sync for an
+    orders file, and merges orders modified since then into the orders that
+    are already in the file.
+
+    """
+    def __init__(self, orders_file, method, page_concurrency=None,
+                 projected=False):
+        self.orders_file = orders_file
+        self.method = method
+        self.page_concurrency = page_concurrency
+        self.projected = projected
+        self.state_file = Path(config.ORDERS_DIR) / SYNC_STATE_FILE
+        self.state = util.read_json(self.state_file) \
+            if self.state_file.exists() else {}
+        self.last_sync = self.state.get(orders_file.name, {})
+        self.payload = util.read_json(orders_file)['payload'] \
+            if orders_file.exists() else {}
+        # Sync times of the accounts that were downloaded during this run.
+        self.sync_times = {}
+
+    def download_account(self, user_id, cred):
+        request = OrderRequest(
+            cred, page_concurrency=self.page_concurrency,
+            projected=self.projected)
+        keep = ORDER_FILTERS[self.method]
+        since = self.last_sync.get(user_id)
+        window_start = arrow.utcnow().replace(days=-RECENT_DAYS_BACK)
+
+        if since is None or user_id not in self.payload or \
+                arrow.get(since) < window_start:
+            # Nothing usable to merge into, so download the whole window.
+            orders = list(getattr(request, self.method)())
+        else:
+            changed = request.get_orders(modified_since=arrow.get(since))
+            orders = merge_orders(
+                self.payload[user_id], changed, keep, window_start)
+
+        self.sync_times[user_id] = request.end.isoformat()
+        return orders
+
+    def save_state(self):
+        self.last_sync.update(self.sync_times)
+        self.state[self.orders_file.name] = self.last_sync
+        util.write_json(self.state, self.state_file)
+
+
+def merge_orders(orders, changed_orders, keep, created_after):
+    """
+    Merge changed_orders into orders by OrderID. Changed orders that are no
+    longer completed and paid (e.g. cancelled orders), or for which
+    keep(order) is false, are removed, as are orders created before
+    created_after.
+
+    """
+    orders_by_id = OrderedDict((o['OrderID'], o) for o in orders)
+
+    for order in changed_orders:
+        if is_completed(order) and keep(order):
+            orders_by_id[order['OrderID']] = order
+        else:
+            orders_by_id.pop(order['OrderID'], None)
+
+    return [order for order in orders_by_id.values()
+            if arrow.get(order['CreatedTime']) >= created_after]
+
+
+def load_orders(json_file, username=None, use_store=None, lazy=False,
+                snapshot=False):
+    """
+    Load a download and add derived fields to each order. If username is
+    given, only that user's orders are loaded.
+
+    If use_store is True (default: config.USE_ORDER_STORE), the orders are
+    queried from the order store instead of parsed from the JSON file.
+
+    If lazy is True, each order is wrapped in a LazyOrder, which computes the
+    derived fields when they are first accessed.
+
+    If snapshot is True, the fully loaded result is read from a pickle
+    snapshot next to the source file, which is only rebuilt when the source
+    file or the item CSV files change. lazy is ignored in that case.
+
+    """
+    if use_store is None:
+        use_store = config.USE_ORDER_STORE
+
+    if snapshot:
+        result = load_snapshot(json_file, use_store)
+        if username is not None:
+            result['payload'] = {
+                u: orders for u, orders in result['payload'].items()
+                if u == username}
+        return result
+
+    result = read_download(json_file, username, use_store)
+    return enrich_download(result, lazy)
+
+
+def read_download(json_file, username=None, use_store=False):
+    "Return a download as it was written by download_orders()."
+    if use_store:
+        from orderstore import OrderStore
+        store = OrderStore()
+        try:
+            return store.get_download(json_file, username=username)
+        finally:
+            store.close()
+
     orders_file = Path(config.ORDERS_DIR) / json_file
     with orders_file.open() as fp:
         result = json.load(fp)
-        # Convert download_time to a datetime object.
-        result['download_time'] = util.str_to_local_time(result['download_time'])
+    if username is not None:
+        result['payload'] = {
+            u: orders for u, orders in result['payload'].items()
+            if u == username}
+    return result
 
-        for username, orders in result['payload'].items():
-            for order in orders:
-                order['PaidTime'] = util.str_to_local_time(order['PaidTime'])
-                order['items'] = list(get_items(order))
-                order['packing_info'] = util.get_packing_info(order)
-                order['address'] = get_address(order)
-                order['shipping_url'] = get_shipping_url(order)
-                order['username'] = username
 
+def enrich_download(result, lazy=False):
+    "Add derived fields to every order in the given download."
+    # Convert download_time to a datetime object.
+    result['download_time'] = util.str_to_local_time(result['download_time'])
+
+    if lazy:
+        for username, orders in result['payload'].items():
+            orders[:] = [LazyOrder(order, username) for order in orders]
         return result
 
+    # Convert the paid times of all accounts at once, since a buyer who
+    # checks out from several of our accounts gets the same PaidTime in each.
+    user_orders = [
+        (username, order)
+        for username, orders in result['payload'].items()
+        for order in orders]
+    paid_times = util.strs_to_local_times(
+        order['PaidTime'] for _, order in user_orders)
+    for (username, order), paid_time in zip(user_orders, paid_times):
+        order['PaidTime'] = paid_time
+        order['items'] = list(get_items(order))
+        order['packing_info'] = util.get_packing_info(order)
+        order['address'] = get_address(order)
+        order['shipping_url'] = get_shipping_url(order)
+        order['username'] = username
+
+    return result
+
+
+def load_snapshot(json_file, use_store=False):
+    """
+    Return the enriched download for json_file from its snapshot, rebuilding
+    the snapshot if it is missing or out of date.
+
+    """
+    orders_dir = Path(config.ORDERS_DIR)
+    if use_store:
+        from orderstore import ORDERS_DB
+        source_file = orders_dir / ORDERS_DB
+        snapshot_file = orders_dir / (json_file + '.store' + SNAPSHOT_SUFFIX)
+    else:
+        source_file = orders_dir / json_file
+        snapshot_file = orders_dir / (json_file + SNAPSHOT_SUFFIX)
+
+    key = get_snapshot_key(source_file)
+    try:
+        with snapshot_file.open('rb') as fp:
+            saved_key, result = pickle.load(fp)
+        if saved_key == key:
+            return result
+    except FileNotFoundError:
+        pass
+    except Exception as ex:
+        log('Ignoring unreadable snapshot {}: {!r}'.format(snapshot_file, ex))
+
+    result = enrich_download(read_download(json_file, use_store=use_store))
+
+    # Write to a temp file first so readers never see a partial snapshot, and
+    # give each writer its own temp file so concurrent rebuilds don't clash.
+    with tempfile.NamedTemporaryFile(
+            dir=str(orders_dir), prefix=snapshot_file.name + '.',
+            suffix='.tmp', delete=False) as fp:
+        try:
+            pickle.dump((key, result), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            fp.close()
+            os.remove(fp.name)
+            raise
+    os.replace(fp.name, str(snapshot_file))
+    return result
+
+
+def get_snapshot_key(source_file):
+    """
+    Return the snapshot format version, the time zone that paid times are
+    converted to, and the modification times and sizes of the source file and
+    the item CSV files that enriched orders are derived from.
+
+    """
+    files = [source_file] + [util.here / name for name in util.ITEM_CSV_FILES]
+    key = [SNAPSHOT_VERSION, config.TIME_ZONE]
+    for path in files:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            key.append((str(path), None, None))
+        else:
+            key.append((str(path), stat.st_mtime_ns, stat.st_size))
+    return key
+
+
+class LazyOrder:
+    """
+    Wraps a downloaded order dict. The fields that load_orders() normally adds
+    are computed on first access and cached; all other keys are read from the
+    wrapped dict.
+
+    """
+    __slots__ = ('order', 'username', '_paid_time', '_items', '_packing_info',
+                 '_address', '_shipping_url')
+
+    # Maps each derived key to its cache slot and the function that computes
+    # it from the LazyOrder.
+    derived = {
+        'PaidTime': ('_paid_time',
+                     lambda o: util.str_to_local_time(o.order['PaidTime'])),
+        'items': ('_items', lambda o: list(get_items(o.order))),
+        'packing_info': ('_packing_info', util.get_packing_info),
+        'address': ('_address', lambda o: get_address(o.order)),
+        'shipping_url': ('_shipping_url', lambda o: get_shipping_url(o.order)),
+    }
+
+    def __init__(self, order, username):
+        self.order = order
+        self.username = username
+        for slot, _ in self.derived.values():
+            setattr(self, slot, _UNSET)
+
+    def __getitem__(self, key):
+        if key == 'username':
+            return self.username
+
+        entry = self.derived.get(key)
+        if entry is None:
+            return self.order[key]
+
+        slot, compute = entry
+        value = getattr(self, slot)
+        if value is _UNSET:
+            value = compute(self)
+            setattr(self, slot, value)
+        return value
+
+    def __setitem__(self, key, value):
+        if key == 'username':
+            self.username = value
+        elif key in self.derived:
+            setattr(self, self.derived[key][0], value)
+        else:
+            self.order[key] = value
+
+    def __contains__(self, key):
+        return key == 'username' or key in self.derived or key in self.order
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return 'LazyOrder<{}>'.format(self.order.get('OrderID'))
+
+
+_UNSET = object()
+
 
 class OrderRequest:
-    def __init__(self, credentials):
+    def __init__(self, credentials, page_concurrency=None, projected=False):
+        """
+        If page_concurrency is greater than 1, pages 2..N of each GetOrders
+        call are fetched in parallel using that many threads.
+
+        If projected is True, GetOrders only returns the fields in ORDER_FIELDS.
+
+        """
         self.credentials = credentials
-        self.api = Trading(config_file=None, **self.credentials)
+        self.page_concurrency = page_concurrency
+        self.projected = projected
+        self.api = get_trading_api(self.credentials)
+        # Trading connections keep per-call state, so each worker thread gets
+        # its own.
+        self._local = threading.local()
 
     def get_orders_awaiting_shipment(self):
-        for order in self.get_orders(days_back=2):
+        for order in self.get_orders(days_back=RECENT_DAYS_BACK):
             # Only yield orders that haven't yet been shipped.
-            if 'ShippedTime' not in order:
+            if is_awaiting_shipment(order):
                 yield order
 
     def get_shipped_orders(self):
-        for order in self.get_orders(days_back=2):
+        for order in self.get_orders(days_back=RECENT_DAYS_BACK):
             # Only yield orders that have been shipped.
-            if 'ShippedTime' in order:
+            if is_shipped(order):
                 yield order
 
-    def get_orders(self, days_back=DAYS_BACK):
+    def get_orders(self, days_back=DAYS_BACK, modified_since=None):
+        """
+        Yield completed, paid orders created in the last days_back days.
+
+        If modified_since is given, yield orders of any status that were
+        modified since then instead, paid or not, so that callers also see
+        orders that have been cancelled.
+
+        """
         self.start = arrow.utcnow().replace(days=-days_back)
         # The API doesn't like time values that it thinks are in the future.
         self.end = arrow.utcnow().replace(seconds=-5)
+        if modified_since is None:
+            self.time_filter = {
+                'CreateTimeFrom': self.start,
+                'CreateTimeTo': self.end,
+            }
+            self.order_status = 'Completed'
+        else:
+            self.time_filter = {
+                'ModTimeFrom': modified_since,
+                'ModTimeTo': self.end,
+            }
+            self.order_status = 'All'
+
+        if self.page_concurrency is not None and self.page_concurrency > 1:
+            yield from self._get_orders_concurrently()
+            return
 
         for page in itertools.count(1):
             response = self._get_orders_for_page(page)
             reply = response.reply
-            print('Page {}, {} items'.format(page, reply.ReturnedOrderCountActual))
-
-            rdict = response.dict()
-            if 'OrderArray' in rdict:
-                orders = rdict['OrderArray']['Order']
-            else:
-                orders = ()
-
-            for order in orders:
-                # Ignore orders that haven't been paid.
-                if 'PaidTime' not in order:
-                    continue
-                yield order
+            yield from self._get_paid_orders(page, response)
 
             if reply.PageNumber == reply.PaginationResult.TotalNumberOfPages:
                 break
 
+    def _get_orders_concurrently(self):
+        """
+        Fetch the first page, then fetch the remaining pages in parallel. Orders
+        are still yielded in page order.
+
+        """
+        response = self._get_orders_for_page(1)
+        page_count = int(response.reply.PaginationResult.TotalNumberOfPages)
+        yield from self._get_paid_orders(1, response)
+
+        def fetch(page):
+            return page, self._get_orders_for_page(page, api=self._get_api())
+
+        with ThreadPoolExecutor(max_workers=self.page_concurrency) as executor:
+            # map() returns results in the order of its input.
+            for page, response in executor.map(fetch, range(2, page_count + 1)):
+                yield from self._get_paid_orders(page, response)
+
+    def _get_paid_orders(self, page, response):
+        print('Page {}, {} items'.format(
+            page, response.reply.ReturnedOrderCountActual))
+
+        rdict = response.dict()
+        if 'OrderArray' in rdict:
+            orders = rdict['OrderArray']['Order']
+        else:
+            orders = ()
+
+        for order in orders:
+            # Ignore orders that haven't been paid, unless all statuses were
+            # requested.
+            if 'PaidTime' not in order and self.order_status != 'All':
+                continue
+            yield order
+
+    def _get_api(self):
+        "Return the Trading connection for the current thread."
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            api = get_trading_api(self.credentials)
+            self._local.api = api
+        return api
+
     def get_orders_detail(self):
         "Return orders awaiting shipment, including item and address info."
         orders = list(self.get_orders_awaiting_shipment())
@@ -141,26 +602,29 @@ class OrderRequest:
         return orders
 
     def get_order(self, order_id):
-        api = Trading(config_file=None, **self.credentials)
+        api = get_trading_api(self.credentials)
         response = api.execute('GetOrders', {
             'OrderIDArray': [{'OrderID': order_id}]
         })
         return response.reply.OrderArray.Order[0]
 
-    def _get_orders_for_page(self, page):
+    def _get_orders_for_page(self, page, api=None):
         """
         Return the response object for a single page.
 
         """
-        response = self.api.execute('GetOrders', {
-            'CreateTimeFrom': self.start,
-            'CreateTimeTo': self.end,
-            'OrderStatus': 'Completed',
-            'Pagination': {
+        api = api or self.api
+        params = dict(
+            self.time_filter,
+            OrderStatus=self.order_status,
+            Pagination={
                 'PageNumber': page,
                 'EntriesPerPage': 100,
             }
-        })
+        )
+        if self.projected:
+            params['OutputSelector'] = get_output_selector()
+        response = api.execute('GetOrders', params)
         if page == 1:
             pagination = response.reply.PaginationResult
             print('Found {} orders over {} pages'.format(
@@ -168,6 +632,37 @@ class OrderRequest:
         return response
 
 
+def get_trading_api(credentials):
+    # ebaysdk is slow to import, so only import it when making API calls.
+    from ebaysdk.trading import Connection as Trading
+    return Trading(config_file=None, **credentials)
+
+
+def get_output_selector():
+    "Return the OutputSelector paths for a projected GetOrders call."
+    order_paths = ['OrderArray.Order.' + field for field in ORDER_FIELDS]
+    return PAGINATION_FIELDS + order_paths
+
+
+def is_completed(order):
+    return order.get('OrderStatus') == 'Completed' and 'PaidTime' in order
+
+
+def is_awaiting_shipment(order):
+    return 'ShippedTime' not in order
+
+
+def is_shipped(order):
+    return 'ShippedTime' in order
+
+
+# Maps OrderRequest download methods to the test their orders must pass.
+ORDER_FILTERS = {
+    'get_orders_awaiting_shipment': is_awaiting_shipment,
+    'get_shipped_orders': is_shipped,
+}
+
+
 def get_items(order):
     for transaction in order['TransactionArray']['Transaction']:
         item = transaction['Item']
@@ -203,6 +698,26 @@ def get_shipping_url(order):
         return SHIPPING_URL_TEMPLATE_2.format(order_id=order['OrderID'])
 
 
+def get_tracking_numbers_for_order(order):
+    tracking_nums = set()
+
+    transactions = order['TransactionArray']['Transaction']
+    for transaction in transactions:
+        try:
+            details = transaction['ShippingDetails']['ShipmentTrackingDetails']
+        except KeyError:
+            details = []
+
+        if not isinstance(details, list):
+            details = [details]
+
+        for detail in details:
+            tn = detail['ShipmentTrackingNumber']
+            tracking_nums.add(tn)
+
+    return tracking_nums
+
+
 def hours_since(dt):
     "Return the number of hours since given datetime"
     if isinstance(dt, str):
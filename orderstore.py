@@ -0,0 +1,191 @@
+"""
+Indexed SQLite store for downloaded orders.
+
+Each download (e.g. orders.json, shipped_orders.json) is a "source" in the
+store. The JSON files are still written, so the store can always be rebuilt
+from them and exported back to them.
+
+"""
+from pathlib import Path
+from collections import OrderedDict
+import json
+import sqlite3
+
+import config
+
+
+ORDERS_DB = 'orders.db'
+
+SCHEMA = """
+create table if not exists orders(
+    source text,
+    order_id text,
+    username text,
+    buyer text,
+    paid_time text,
+    shipped integer,
+    data text,
+    primary key(source, order_id)
+);
+create index if not exists orders_order_id on orders(order_id);
+create index if not exists orders_buyer on orders(buyer);
+create index if not exists orders_username on orders(source, username);
+create index if not exists orders_paid_time on orders(paid_time);
+create index if not exists orders_shipped on orders(shipped);
+
+create table if not exists order_tracking(
+    source text,
+    order_id text,
+    tracking_number text,
+    primary key(source, order_id, tracking_number)
+);
+create index if not exists order_tracking_number
+    on order_tracking(tracking_number);
+
+create table if not exists downloads(
+    source text primary key,
+    usernames text,
+    meta text
+);
+"""
+
+
+class OrderStore:
+    def __init__(self, db_file=None):
+        if db_file is None:
+            db_file = Path(config.ORDERS_DIR) / ORDERS_DB
+        self.conn = sqlite3.connect(str(db_file))
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def write_download(self, source, result):
+        """
+        Replace all orders for source with those in result, which has the same
+        structure as the downloaded JSON files.
+
+        """
+        from orders import get_tracking_numbers_for_order
+
+        meta = {k: v for k, v in result.items() if k != 'payload'}
+        order_rows = []
+        tracking_rows = []
+
+        for username, orders in result['payload'].items():
+            for order in orders:
+                order_rows.append((
+                    source,
+                    order['OrderID'],
+                    username,
+                    order['BuyerUserID'],
+                    order.get('PaidTime'),
+                    int('ShippedTime' in order),
+                    json.dumps(order),
+                ))
+                for tn in get_tracking_numbers_for_order(order):
+                    tracking_rows.append((source, order['OrderID'], tn))
+
+        with self.conn:
+            self.conn.execute('delete from orders where source = ?', (source,))
+            self.conn.execute(
+                'delete from order_tracking where source = ?', (source,))
+            self.conn.executemany(
+                'insert or replace into orders values (?, ?, ?, ?, ?, ?, ?)',
+                order_rows)
+            self.conn.executemany(
+                'insert or ignore into order_tracking values (?, ?, ?)',
+                tracking_rows)
+            self.conn.execute(
+                'insert or replace into downloads values (?, ?, ?)',
+                (source, json.dumps(list(result['payload'])), json.dumps(meta)))
+
+    def get_download(self, source, username=None):
+        """
+        Return the orders for source in the same structure as the downloaded
+        JSON files. If username is given, the payload only contains that user.
+
+        """
+        row = self.conn.execute(
+            'select usernames, meta from downloads where source = ?',
+            (source,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(
+                'No orders for {} in the order store'.format(source))
+
+        usernames, meta = json.loads(row[0]), json.loads(row[1])
+        if username is not None:
+            usernames = [u for u in usernames if u == username]
+
+        result = dict(meta)
+        result['payload'] = OrderedDict((u, []) for u in usernames)
+
+        sql = 'select username, data from orders where source = ?'
+        params = [source]
+        if username is not None:
+            sql += ' and username = ?'
+            params.append(username)
+        for username_, data in self.conn.execute(sql + ' order by rowid', params):
+            result['payload'][username_].append(json.loads(data))
+
+        return result
+
+    def get_orders(self, source=None, **filters):
+        """
+        Return the orders matching the given filters. The allowed filters are
+        order_id, username, buyer, shipped and paid_after (an ISO 8601 string).
+        Each order gets a 'username' key with its seller's username.
+
+        """
+        columns = {
+            'order_id': 'order_id = ?',
+            'username': 'username = ?',
+            'buyer': 'buyer = ?',
+            'shipped': 'shipped = ?',
+            'paid_after': 'paid_time >= ?',
+        }
+        clauses, params = [], []
+        if source is not None:
+            clauses.append('source = ?')
+            params.append(source)
+        for key, value in filters.items():
+            clauses.append(columns[key])
+            params.append(int(value) if key == 'shipped' else value)
+
+        sql = 'select username, data from orders'
+        if clauses:
+            sql += ' where ' + ' and '.join(clauses)
+        return get_orders_for_rows(
+            self.conn.execute(sql + ' order by rowid', params))
+
+    def get_orders_for_tracking_number(self, tracking_number, source=None):
+        "Like get_orders(), but for the orders linked to a tracking number."
+        sql = """
+            select o.username, o.data from orders o
+            join order_tracking t
+            on o.source = t.source and o.order_id = t.order_id
+            where t.tracking_number = ?"""
+        params = [tracking_number]
+        if source is not None:
+            sql += ' and o.source = ?'
+            params.append(source)
+        return get_orders_for_rows(
+            self.conn.execute(sql + ' order by o.rowid', params))
+
+    def export_json(self, source, json_file=None):
+        "Write the orders for source to a JSON file in ORDERS_DIR."
+        if json_file is None:
+            json_file = source
+        orders_file = Path(config.ORDERS_DIR) / json_file
+        with orders_file.open('w') as fp:
+            json.dump(self.get_download(source), fp, indent=2)
+        return orders_file
+
+
+def get_orders_for_rows(rows):
+    result = []
+    for username, data in rows:
+        order = json.loads(data)
+        order['username'] = username
+        result.append(order)
+    return result
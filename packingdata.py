@@ -6,10 +6,12 @@ import io
 import attr
 from reportlab.pdfgen.canvas import Canvas
 from PyPDF2 import PdfFileReader, PdfFileWriter
-from PyPDF2.pdf import PageObject
 
 import config
-from orders import download_shipped_orders, load_orders
+from orders import (
+    download_shipped_orders, load_orders, get_tracking_numbers_for_order)
+from trackingnumber.extractor import get_pages_for_pdf, contains
+from pdfutil import get_full_size_page, is_half_size_page
 
 
 @attr.s
@@ -172,8 +174,14 @@ class OutputInfo:
 
 
 class PackingInfoAdder:
-    def __init__(self, pdf_files, label_count=None):
+    def __init__(self, pdf_files, label_count=None, batched=False):
+        """
+        If batched is True, each PDF is extracted with a single pdftotext call
+        instead of three cropped calls per page.
+
+        """
         self.pdf_files = pdf_files
+        self.batched = batched
         self._set_input_pages()
         self.label_count = label_count
         with open('orders/tracking_num_to_packing_info.json') as fp:
@@ -222,6 +230,12 @@ class PackingInfoAdder:
         return result
 
     def get_tracking_numbers_from_pdfs(self):
+        if self.batched:
+            for pdf_file in self.pdf_files:
+                for words in get_pages_for_pdf(pdf_file):
+                    yield get_tracking_numbers_from_words(words)
+            return
+
         for page_count, pdf_file in zip(self.page_counts, self.pdf_files):
             for i in range(page_count):
                 yield get_tracking_numbers_from_page(pdf_file, i)
@@ -236,12 +250,9 @@ class PackingInfoAdder:
             self.page_counts.append(reader.numPages)
             for page_index in range(0, reader.numPages):
                 page = reader.getPage(page_index)
-                height = page.mediaBox[3]
-                if height == (5.5 * 72):
+                if is_half_size_page(page):
                     # This is a half-size page, so make it full size.
-                    page2 = get_blank_page()
-                    page2.mergeTranslatedPage(page, tx=0, ty=5.5*72)
-                    page = page2
+                    page = get_full_size_page(page)
                 self.input_pages.append(page)
 
     def _get_packing_info(self, tracking_num):
@@ -284,7 +295,8 @@ class PackingInfoAdder:
 
 
 def get_shipped_orders():
-    for user, orders in load_orders('shipped_orders.json')['payload'].items():
+    download = load_orders('shipped_orders.json', lazy=True)
+    for user, orders in download['payload'].items():
         for order in orders:
             yield order
 
@@ -323,29 +335,35 @@ def generate_tracking_num_to_packing_info_file():
         json.dump(result, fp, indent=2)
 
 
-def get_tracking_numbers_for_order(order):
-    tracking_nums = set()
+def get_tracking_numbers_from_page(pdf_file, page_index):
+    """
+    Return a list of tracking numbers for the given page of the given pdf file.
+
+    """
+    return get_tracking_numbers(
+        lambda bbox: get_text_for_bbox(pdf_file, page_index, bbox))
 
-    transactions = order['TransactionArray']['Transaction']
-    for transaction in transactions:
-        try:
-            details = transaction['ShippingDetails']['ShipmentTrackingDetails']
-        except KeyError:
-            details = []
 
-        if not isinstance(details, list):
-            details = [details]
+def get_tracking_numbers_from_words(words):
+    """
+    Return a list of tracking numbers for a page, given all the words on that
+    page, without running pdftotext for each bounding box.
 
-        for detail in details:
-            tn = detail['ShipmentTrackingNumber']
-            tracking_nums.add(tn)
+    This can differ from get_tracking_numbers_from_page() in two ways. A
+    cropped pdftotext call keeps the characters inside a bounding box, while
+    this keeps whole words whose top left corner is inside it. And the words
+    are joined with nothing between them, while the cropped text only has its
+    spaces removed, so text spanning several lines keeps its line breaks.
 
-    return tracking_nums
+    """
+    return get_tracking_numbers(
+        lambda bbox: get_text_for_bbox_from_words(words, bbox))
 
 
-def get_tracking_numbers_from_page(pdf_file, page_index):
+def get_tracking_numbers(get_text):
     """
-    Return a list of tracking numbers for the given page of the given pdf file.
+    Return a list of tracking numbers for a page, where get_text(bbox) returns
+    the text on the page inside bbox.
 
     """
     import re
@@ -354,14 +372,14 @@ def get_tracking_numbers_from_page(pdf_file, page_index):
 
     for type in ('domestic-top', 'domestic-bottom'):
         bbox = TrackingNumberReadMeta.get(type).bbox
-        text = get_text_for_bbox(pdf_file, page_index, bbox)
+        text = get_text(bbox)
         # Must be 22-digit number.
         if re.match(r'\d{22}', text):
             tn = TrackingNumber(type=type, value=text)
             result.append(tn)
 
     foreign = TrackingNumberReadMeta.get('foreign')
-    text = get_text_for_bbox(pdf_file, page_index, foreign.bbox)
+    text = get_text(foreign.bbox)
     # Must be two letters, then 9 digits, then 'US'.
     if re.match(r'[A-Z]{2}\d{9}US', text):
         tn = TrackingNumber(type='foreign', value=text)
@@ -370,6 +388,12 @@ def get_tracking_numbers_from_page(pdf_file, page_index):
     return result
 
 
+def get_text_for_bbox_from_words(words, bbox):
+    "Return the text of all words whose top left corner is inside bbox."
+    return ''.join(word.text for word in words
+                   if contains(bbox, (word.x, word.y)))
+
+
 def get_text_for_bbox(pdf_file, page_index, bbox):
     """
     For the given PDF file, return all the text on page `page_index` inside
@@ -398,7 +422,3 @@ def get_text_for_bbox(pdf_file, page_index, bbox):
     result = result.decode('utf-8')
     return result.strip().replace(' ', '')      # get rid of all extraneous spaces
 
-
-def get_blank_page():
-    inch = 72
-    return PageObject.createBlankPage(width=8.5*inch, height=11*inch)
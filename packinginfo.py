@@ -1,14 +1,21 @@
 from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import math
+import os
+import tempfile
 import textwrap
 import io
 
 import attr
 from reportlab.pdfgen.canvas import Canvas
 from PyPDF2 import PdfFileReader, PdfFileWriter
-from PyPDF2.pdf import PageObject
 from clint.textui import puts, colored
 
 from trackingnumber import TrackingNumberExtractor, TrackingNumberMapper
+from pdfutil import (
+    concatenate_pdfs, dedupe_resources, get_full_size_page, is_half_size_page)
 
 
 @attr.s
@@ -172,31 +179,213 @@ def get_username(text):
     return OutputMeta.get_output_info('username', 'User: {}'.format(text))
 
 
+PAGE_SIZE = (8.5 * 72, 11 * 72)
+# Number of pages in each temporary part file in streaming mode.
+STREAMING_PART_SIZE = 100
+
+
 class PackingInfoWriter:
-    def __init__(self, label_count=None, simple_orders_file=None):
+    def __init__(self, label_count=None, simple_orders_file=None,
+                 use_cache=True, processes=None, backend='pdftotext',
+                 indexed_mapper=True, mapper_db_file=None,
+                 single_document=True, streaming=False, render_processes=None,
+                 dedupe=False):
+        """
+        If mapper_db_file is given, the mapper keeps its SQL database in that
+        file between runs instead of indexing the orders in memory.
+
+        If single_document is True, all overlay pages are drawn into one PDF
+        document that is parsed once, instead of one document per page.
+
+        If streaming is True, input files are read and written one at a time
+        when the output file is written, instead of loading every input page
+        up front, so memory use doesn't grow with the number of labels.
+
+        If render_processes is greater than 1, overlays are rendered and merged
+        on a pool of that many processes. Each process writes a contiguous
+        range of pages to a part file, and the parts are concatenated in order.
+
+        If dedupe is True, each output file is rewritten so that identical
+        fonts, images and other resources are only stored once. This loads the
+        whole output file into memory.
+
+        """
         self.label_count = label_count
-        self.extractor = TrackingNumberExtractor('.')
-        self._set_input_pages()
-        self.mapper = TrackingNumberMapper(simple_orders_file)
+        self.single_document = single_document
+        self.streaming = streaming
+        self.render_processes = render_processes
+        self.dedupe = dedupe
+        self.extractor = TrackingNumberExtractor(
+            '.', use_cache=use_cache, processes=processes, backend=backend)
+        if not streaming and not self._is_parallel():
+            self._set_input_pages()
+        self.mapper = TrackingNumberMapper(
+            simple_orders_file,
+            indexed=indexed_mapper and mapper_db_file is None,
+            db_file=mapper_db_file)
+
+    def write_output_file(self, output_file=None, chunk_size=None):
+        """
+        If chunk_size is given, the output is written as numbered part files
+        of chunk_size pages (e.g. "... part 01+packing.pdf"), and each part is
+        written as soon as its pages have been merged, so printing can start
+        before the whole batch is done. Page numbers are still counted across
+        the whole batch.
+
+        """
+        if self._is_parallel():
+            self._write_parallel(output_file, chunk_size)
+            return
+
+        # In chunked mode, overlays are rendered one chunk at a time, just
+        # before the chunk's part file is written.
+        pages = self._get_merged_pages(chunk_size)
+
+        if chunk_size is not None:
+            # All parts get the same timestamp in their names.
+            now = datetime.now()
+            get_part_file = lambda part_num: get_part_file_name(
+                self._get_output_file(output_file, now), part_num)
+            for part_file in write_parts(pages, chunk_size, get_part_file):
+                self._finish_output_file(part_file)
+            return
+
+        if self.streaming:
+            self._write_streaming(pages, output_file)
+            return
 
-    def write_output_file(self, output_file=None):
         writer = PdfFileWriter()
-        output_pages = self.get_output_pages()
-
-        for input_page, output_page in zip(self.input_pages, output_pages):
-            input_page.mergePage(output_page)
-            writer.addPage(input_page)
+        for page in pages:
+            writer.addPage(page)
 
-        if output_file is None:
-            output_file = '{:%Y-%m-%d %H%M} ({})+packing.pdf'.format(
-                datetime.now(), self.label_count)
+        output_file = self._get_output_file(output_file)
         with open(output_file, 'wb') as fp:
             writer.write(fp)
+        self._finish_output_file(output_file)
+
+    def _write_streaming(self, pages, output_file):
+        """
+        Write the pages to part files of STREAMING_PART_SIZE pages in a
+        temporary directory, and then concatenate the parts.
+
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            get_part_file = lambda part_num: get_temp_part_file(
+                temp_dir, part_num)
+            part_files = list(
+                write_parts(pages, STREAMING_PART_SIZE, get_part_file))
+
+            output_file = self._get_output_file(output_file)
+            concatenate_pdfs(part_files, output_file)
+        self._finish_output_file(output_file)
+
+    def _write_parallel(self, output_file, chunk_size):
+        """
+        Split the pages into contiguous ranges and have each worker process
+        render, merge and write one range to a part file. If chunk_size is
+        given, the parts are the numbered output files. Otherwise there is one
+        range per process, and the parts are concatenated into output_file.
+
+        """
+        output_infos = self.get_output_infos()
+        locations = list(self._get_page_locations())
+        now = datetime.now()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            if chunk_size is None:
+                size = math.ceil(len(locations) / self.render_processes)
+                size = max(size, 1)
+                get_part_file = lambda part_num: get_temp_part_file(
+                    temp_dir, part_num)
+            else:
+                size = chunk_size
+                get_part_file = lambda part_num: get_part_file_name(
+                    self._get_output_file(output_file, now), part_num)
+
+            starts = range(0, len(locations), size)
+            part_files = [get_part_file(i) for i in range(1, len(starts) + 1)]
+            with ProcessPoolExecutor(
+                    max_workers=self.render_processes) as executor:
+                results = executor.map(
+                    write_part,
+                    part_files,
+                    [locations[i:i+size] for i in starts],
+                    [output_infos[i:i+size] for i in starts],
+                    itertools.repeat(self.single_document))
+                for part_file in results:
+                    if chunk_size is not None:
+                        self._finish_output_file(part_file)
+
+            if chunk_size is None:
+                output_file = self._get_output_file(output_file, now)
+                concatenate_pdfs(part_files, output_file)
+                self._finish_output_file(output_file)
+
+    def _get_page_locations(self):
+        "Yield (pdf_file, page_index) for every input page, in order."
+        for pdf_file in self.extractor.input_files:
+            with pdf_file.open('rb') as fp:
+                page_count = PdfFileReader(fp, strict=False).numPages
+            for page_index in range(page_count):
+                yield pdf_file, page_index
+
+    def _is_parallel(self):
+        return self.render_processes is not None and self.render_processes > 1
+
+    def _get_merged_pages(self, batch_size=None):
+        """
+        Yield the merged output pages in order. In streaming mode, only one
+        input file is open at a time. See get_output_pages() for batch_size.
+
+        """
+        if not self.streaming:
+            yield from get_merged_pages(
+                self.input_pages, self.get_output_pages(batch_size=batch_size))
+            return
+
+        output_infos = iter(self.get_output_infos())
+        for pdf_file in self.extractor.input_files:
+            # Read the whole file so that its handle can be closed now.
+            with pdf_file.open('rb') as fp:
+                buf = io.BytesIO(fp.read())
+            reader = PdfFileReader(buf, strict=False)
+            infos = list(itertools.islice(output_infos, reader.numPages))
+            yield from get_merged_pages(
+                get_input_pages(reader),
+                self.get_output_pages(infos, batch_size))
+
+    def _finish_output_file(self, output_file):
+        if self.dedupe:
+            before, after = dedupe_resources(output_file)
+            print('Deduplicated resources: {:.1f} KB -> {:.1f} KB'.format(
+                before / 1024, after / 1024))
         print('Wrote output to ' + output_file)
 
-    def get_output_pages(self):
-        for infos in self.get_output_infos():
-            yield self._get_output_page(infos)
+    def _get_output_file(self, output_file, now=None):
+        if output_file is None:
+            output_file = '{:%Y-%m-%d %H%M} ({})+packing.pdf'.format(
+                now or datetime.now(), self.label_count)
+        return output_file
+
+    def get_output_pages(self, output_infos=None, batch_size=None):
+        """
+        Yield the overlay page for each list of output infos. In single
+        document mode, if batch_size is given, the overlays are rendered into
+        one document per batch_size pages, and each batch is only rendered
+        when its first page is needed.
+
+        """
+        if output_infos is None:
+            output_infos = self.get_output_infos()
+
+        if self.single_document:
+            if batch_size is None:
+                batch_size = max(len(output_infos), 1)
+            for i in range(0, len(output_infos), batch_size):
+                yield from render_output_pages(output_infos[i:i+batch_size])
+        else:
+            for infos in output_infos:
+                yield render_output_page(infos)
 
     def get_output_infos(self):
         result = []
@@ -206,10 +395,16 @@ class PackingInfoWriter:
         if self.label_count is None:
             self.label_count = sum(len(lst) for lst in tracking_num_collection)
 
+        # Resolve every tracking number in the batch at once.
+        outputs = self.mapper.get_outputs(
+            tn.value for tracking_numbers in tracking_num_collection
+            for tn in tracking_numbers)
+
         for i, tracking_numbers in enumerate(tracking_num_collection, 1):
-            output_infos = list(self._get_output_infos(tracking_numbers))
+            output_infos = list(
+                self._get_output_infos(tracking_numbers, outputs))
 
-            username = self._get_username(tracking_numbers)
+            username = self._get_username(tracking_numbers, outputs)
             if username:
                 output_infos.append(get_username(username))
 
@@ -228,19 +423,11 @@ class PackingInfoWriter:
         for pdf_file in self.extractor.input_files:
             # EBay label PDFs are a bit weird, so set strict to False.
             reader = PdfFileReader(pdf_file.open('rb'), strict=False)
-            for page_index in range(0, reader.numPages):
-                page = reader.getPage(page_index)
-                height = page.mediaBox[3]
-                if height == (5.5 * 72):
-                    # This is a half-size page, so make it full size.
-                    page2 = get_blank_page()
-                    page2.mergeTranslatedPage(page, tx=0, ty=5.5*72)
-                    page = page2
-                self.input_pages.append(page)
-
-    def _get_output_infos(self, tracking_numbers):
+            self.input_pages.extend(get_input_pages(reader))
+
+    def _get_output_infos(self, tracking_numbers, outputs):
         for tn in tracking_numbers:
-            output = self.mapper.get_output(tn.value)
+            output = outputs.get(tn.value)
             if output is None:
                 tmpl = 'Found no orders linked to {} tracking number {} on page {} of {}'
                 warning = tmpl.format(tn.type, tn.value, tn.page_number, tn.input_file)
@@ -265,41 +452,151 @@ class PackingInfoWriter:
                 yield OutputMeta.get_output_info(
                     tn.type + '-notes', notes)
 
-    def _get_username(self, tracking_numbers):
+    def _get_username(self, tracking_numbers, outputs):
         for tn in tracking_numbers:
-            output = self.mapper.get_output(tn.value)
+            output = outputs.get(tn.value)
             if output is not None:
                 return output['username']
 
         return None
 
-    def _get_output_page(self, output_infos):
-        inch = 72
-        buf = io.BytesIO()
-        canvas = Canvas(buf, pagesize=(8.5*inch, 11*inch))
 
-        for info in output_infos:
-            canvas.saveState()
-            x, y = info.translate
-            # We flip the y coordinate since that's how PDF programs give us
-            # the number of pixels from the top, not the bottom.
-            y = 11*inch - y
-            canvas.translate(x, y)
-            if info.rotate != 0:
-                canvas.rotate(info.rotate)
+def write_part(part_file, locations, output_infos, single_document=True):
+    """
+    Render output_infos, merge them onto the input pages at locations (a list
+    of (pdf_file, page_index)), and write the result to part_file. This runs
+    in the worker processes of PackingInfoWriter.
 
-            t = canvas.beginText()
-            t.setFont('Courier', 10)
-            t.setTextOrigin(0, 0)
-            t.textLines(info.text)
-            canvas.drawText(t)
+    """
+    readers = {}
+    input_pages = []
+    for pdf_file, page_index in locations:
+        if pdf_file not in readers:
+            with pdf_file.open('rb') as fp:
+                buf = io.BytesIO(fp.read())
+            readers[pdf_file] = PdfFileReader(buf, strict=False)
+        input_pages.append(
+            normalize_page(readers[pdf_file].getPage(page_index)))
+
+    if single_document:
+        output_pages = render_output_pages(output_infos)
+    else:
+        output_pages = [render_output_page(infos) for infos in output_infos]
+
+    writer = PdfFileWriter()
+    for page in get_merged_pages(input_pages, output_pages):
+        writer.addPage(page)
+    with open(part_file, 'wb') as fp:
+        writer.write(fp)
+    return part_file
+
+
+def get_input_pages(reader):
+    "Yield the pages of reader, with half-size pages made full size."
+    for page_index in range(0, reader.numPages):
+        yield normalize_page(reader.getPage(page_index))
+
+
+def normalize_page(page):
+    if is_half_size_page(page):
+        # This is a half-size page, so make it full size.
+        page = get_full_size_page(page)
+    return page
+
+
+def get_merged_pages(input_pages, output_pages):
+    "Yield each input page with its output page merged on top."
+    for input_page, output_page in zip(input_pages, output_pages):
+        input_page.mergePage(output_page)
+        yield input_page
+
+
+def write_parts(pages, chunk_size, get_part_file):
+    """
+    Write pages to part files of chunk_size pages each, and yield the name of
+    each part file once it has been written. get_part_file is called with the
+    part number (starting at 1) and returns the file name.
 
-            canvas.restoreState()
+    """
+    pages = iter(pages)
+    part_num = 1
+    while True:
+        chunk = list(itertools.islice(pages, chunk_size))
+        if not chunk:
+            break
+
+        writer = PdfFileWriter()
+        for page in chunk:
+            writer.addPage(page)
+        part_file = get_part_file(part_num)
+        with open(part_file, 'wb') as fp:
+            writer.write(fp)
+        yield part_file
+        part_num += 1
+
+
+def get_part_file_name(output_file, part_num):
+    """
+    Return the name of a numbered part of output_file. The name still ends
+    with +packing.pdf, so the part isn't mistaken for an input file.
+
+    """
+    suffix = '+packing.pdf'
+    if output_file.endswith(suffix):
+        base = output_file[:-len(suffix)]
+    else:
+        base, suffix = os.path.splitext(output_file)
+    return '{} part {:02}{}'.format(base, part_num, suffix)
+
+
+def get_temp_part_file(temp_dir, part_num):
+    "Return the name of a numbered part file in a temporary directory."
+    return str(Path(temp_dir) / 'part{:04}.pdf'.format(part_num))
 
-        canvas.save()
-        return PdfFileReader(buf).getPage(0)
 
+def render_output_page(output_infos):
+    "Render the output infos of one page to a new PDF and return its page."
+    buf = io.BytesIO()
+    canvas = Canvas(buf, pagesize=PAGE_SIZE)
+    draw_output_infos(canvas, output_infos)
+    canvas.save()
+    return PdfFileReader(buf).getPage(0)
 
-def get_blank_page():
+
+def render_output_pages(output_infos_list):
+    """
+    Render the output infos of each page as a page of a single PDF, and return
+    a list of its pages. The PDF is only written and parsed once.
+
+    """
+    buf = io.BytesIO()
+    canvas = Canvas(buf, pagesize=PAGE_SIZE)
+    for output_infos in output_infos_list:
+        draw_output_infos(canvas, output_infos)
+        canvas.showPage()
+    canvas.save()
+
+    reader = PdfFileReader(buf)
+    return [reader.getPage(i) for i in range(reader.numPages)]
+
+
+def draw_output_infos(canvas, output_infos):
     inch = 72
-    return PageObject.createBlankPage(width=8.5*inch, height=11*inch)
+    for info in output_infos:
+        canvas.saveState()
+        x, y = info.translate
+        # We flip the y coordinate since that's how PDF programs give us
+        # the number of pixels from the top, not the bottom.
+        y = 11*inch - y
+        canvas.translate(x, y)
+        if info.rotate != 0:
+            canvas.rotate(info.rotate)
+
+        t = canvas.beginText()
+        t.setFont('Courier', 10)
+        t.setTextOrigin(0, 0)
+        t.textLines(info.text)
+        canvas.drawText(t)
+
+        canvas.restoreState()
+
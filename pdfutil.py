@@ -0,0 +1,200 @@
+"""
+Helpers for working with PDF files.
+
+"""
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import (
+    ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject,
+    NameObject, StreamObject)
+from PyPDF2.pdf import PageObject
+
+
+inch = 72
+PAGE_WIDTH = 8.5 * inch
+PAGE_HEIGHT = 11 * inch
+HALF_PAGE_HEIGHT = 5.5 * inch
+
+# Resource name of the original page in a page made by get_full_size_page().
+FORM_NAME = '/HalfPage'
+
+
+def concatenate_pdfs(input_files, output_file):
+    """
+    Concatenate input_files, in order, into output_file. This uses the
+    external pdfunite program (from poppler, like pdftotext), so the documents
+    are never loaded into memory here. If there are no input files, an empty
+    document is written, since pdfunite needs at least one input.
+
+    """
+    input_files = [str(f) for f in input_files]
+    if not input_files:
+        with open(str(output_file), 'wb') as fp:
+            PdfFileWriter().write(fp)
+        return
+    if len(input_files) == 1:
+        shutil.copyfile(input_files[0], str(output_file))
+        return
+
+    cmd = ['pdfunite'] + input_files + [str(output_file)]
+    subprocess.run(cmd, check=True)
+
+
+def is_half_size_page(page):
+    return page.mediaBox[3] == HALF_PAGE_HEIGHT
+
+
+def get_full_size_page(page):
+    """
+    Return a letter-size page that shows the half-size page in its top half.
+
+    The original content stream is turned into a form XObject and drawn by a
+    tiny new content stream, so the label's content is never decoded or
+    re-encoded. If the page's contents are an array of streams, fall back to
+    merge_full_size_page().
+
+    """
+    contents = page.raw_get('/Contents') if '/Contents' in page else None
+    if not isinstance(contents, IndirectObject) or \
+            not isinstance(contents.getObject(), StreamObject):
+        return merge_full_size_page(page)
+
+    resources = page.raw_get('/Resources') if '/Resources' in page \
+        else DictionaryObject()
+    form = contents.getObject()
+    form[NameObject('/Type')] = NameObject('/XObject')
+    form[NameObject('/Subtype')] = NameObject('/Form')
+    form[NameObject('/BBox')] = page.mediaBox
+    form[NameObject('/Resources')] = resources
+
+    content = DecodedStreamObject()
+    content.setData('q 1 0 0 1 0 {:g} cm {} Do Q'.format(
+        HALF_PAGE_HEIGHT, FORM_NAME).encode('ascii'))
+
+    result = get_blank_page()
+    result[NameObject('/Resources')] = DictionaryObject({
+        NameObject('/XObject'): DictionaryObject({
+            NameObject(FORM_NAME): contents,
+        }),
+    })
+    result[NameObject('/Contents')] = content
+    return result
+
+
+def merge_full_size_page(page):
+    """
+    Return a letter-size page that shows the half-size page in its top half,
+    by merging the page's content into a blank page.
+
+    """
+    result = get_blank_page()
+    result.mergeTranslatedPage(page, tx=0, ty=HALF_PAGE_HEIGHT)
+    return result
+
+
+def get_blank_page():
+    return PageObject.createBlankPage(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+
+
+def dedupe_resources(pdf_file):
+    """
+    Rewrite pdf_file so that identical fonts, images and other objects used
+    by the page resources are stored only once. Return the file size before
+    and after.
+
+    """
+    with open(str(pdf_file), 'rb') as fp:
+        buf = io.BytesIO(fp.read())
+    before = len(buf.getvalue())
+
+    reader = PdfFileReader(buf, strict=False)
+    deduper = ResourceDeduper()
+    writer = PdfFileWriter()
+    for page_index in range(reader.numPages):
+        page = reader.getPage(page_index)
+        if '/Resources' in page:
+            page[NameObject('/Resources')] = deduper.dedupe_value(
+                page.raw_get('/Resources'))
+        writer.addPage(page)
+
+    with open(str(pdf_file), 'wb') as fp:
+        writer.write(fp)
+    return before, os.path.getsize(str(pdf_file))
+
+
+class ResourceDeduper:
+    """
+    Content-hashes the objects that page resources refer to, and replaces
+    references to duplicate objects with references to the first object that
+    had the same content. Nested objects (e.g. the font file of a font, or the
+    resources of a form XObject) are deduplicated too.
+
+    """
+    def __init__(self):
+        # (idnum, generation) -> content hash
+        self.hashes = {}
+        # content hash -> first reference with that content
+        self.canonical = {}
+        # ids of dicts and arrays whose references have been rewritten
+        self.visited = set()
+
+    def dedupe_value(self, value):
+        "Return the reference to use for value, and dedupe what it contains."
+        if isinstance(value, IndirectObject):
+            value = self.canonical.setdefault(self.get_hash(value), value)
+            self._dedupe_children(value.getObject())
+        elif isinstance(value, (DictionaryObject, ArrayObject)):
+            self._dedupe_children(value)
+        return value
+
+    def _dedupe_children(self, obj):
+        if id(obj) in self.visited:
+            return
+        self.visited.add(id(obj))
+
+        if isinstance(obj, DictionaryObject):
+            # dict.items() gives the unresolved values.
+            for key, value in list(dict.items(obj)):
+                if key != '/Parent':
+                    obj[key] = self.dedupe_value(value)
+        elif isinstance(obj, ArrayObject):
+            for i, value in enumerate(obj):
+                obj[i] = self.dedupe_value(value)
+
+    def get_hash(self, obj, stack=()):
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key not in self.hashes:
+                if key in stack:
+                    # A reference cycle, so just use the reference itself.
+                    return 'ref {} {}'.format(*key)
+                self.hashes[key] = self.get_hash(
+                    obj.getObject(), stack + (key,))
+            return self.hashes[key]
+
+        sha = hashlib.sha1()
+        if isinstance(obj, DictionaryObject):
+            sha.update(b'stream' if isinstance(obj, StreamObject) else b'dict')
+            for key in sorted(obj):
+                if key not in ('/Length', '/Parent'):
+                    sha.update(key.encode('utf-8'))
+                    sha.update(self.get_hash(
+                        dict.__getitem__(obj, key), stack).encode('ascii'))
+            if isinstance(obj, StreamObject):
+                # The raw (still encoded) stream data.
+                sha.update(obj._data)
+        elif isinstance(obj, ArrayObject):
+            sha.update(b'array')
+            for value in obj:
+                sha.update(self.get_hash(value, stack).encode('ascii'))
+        else:
+            buf = io.BytesIO()
+            obj.writeToStream(buf, None)
+            sha.update(type(obj).__name__.encode('ascii'))
+            sha.update(buf.getvalue())
+        return sha.hexdigest()
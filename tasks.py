@@ -1,39 +1,45 @@
 import json
-from datetime import datetime
 from pathlib import Path
 from collections import OrderedDict, defaultdict
 import subprocess
 
 from invoke import task
-import arrow
 
 import config
-import util
 from misc_tasks import *
 
+# Keep module-level imports light, since every inv command imports this file.
+# Modules that a task needs are imported inside the task.
+
 
 def run(cmd):
     subprocess.call(cmd, shell=True)
 
 
 @task
-def download_orders_awaiting_shipment(ctx):
+def download_orders_awaiting_shipment(ctx, concurrent=False, pages=None,
+                                      incremental=False, projected=False):
     """
     Download orders awaiting shipment.
 
     """
     import orders
-    orders.download_orders_awaiting_shipment()
+    orders.download_orders_awaiting_shipment(
+        concurrent=concurrent, page_concurrency=int(pages) if pages else None,
+        incremental=incremental, projected=projected)
 
 
 @task
-def download_shipped_orders(ctx):
+def download_shipped_orders(ctx, concurrent=False, pages=None,
+                            incremental=False, projected=False):
     """
     Download orders that have been marked as shipped.
 
     """
     import orders
-    orders.download_shipped_orders()
+    orders.download_shipped_orders(
+        concurrent=concurrent, page_concurrency=int(pages) if pages else None,
+        incremental=incremental, projected=projected)
 
 
 @task
@@ -41,6 +47,9 @@ def generate_report(ctx):
     """
     Generate HTML report from downloaded orders data.
     """
+    import arrow
+    import util
+
     orders_dir = Path(config.ORDERS_DIR)
     orders_file = orders_dir / 'orders.json'
     if not orders_file.exists():
@@ -78,6 +87,40 @@ def generate_report(ctx):
         buyer_order_counts=buyer_order_counts)
 
 
+@task
+def rebuild_order_store(ctx):
+    """
+    Rebuild the SQLite order store from the downloaded JSON files.
+
+    """
+    import util
+    from orderstore import OrderStore
+    store = OrderStore()
+    try:
+        for source in ('orders.json', 'shipped_orders.json'):
+            orders_file = Path(config.ORDERS_DIR) / source
+            if orders_file.exists():
+                store.write_download(source, util.read_json(orders_file))
+                print('Imported {}'.format(orders_file))
+    finally:
+        store.close()
+
+
+@task
+def export_orders_json(ctx, source='orders.json'):
+    """
+    Export orders from the SQLite order store to a JSON file.
+
+    """
+    from orderstore import OrderStore
+    store = OrderStore()
+    try:
+        orders_file = store.export_json(source)
+    finally:
+        store.close()
+    print('Exported {}'.format(orders_file))
+
+
 @task
 def combine_pdfs(ctx):
     """
@@ -115,6 +158,9 @@ def send_email(ctx):
     Send an email notifying you of the number of orders awaiting shipment.
 
     """
+    import util
+    from orders import OrderRequest
+
     count = 0
     body = []
 
@@ -183,13 +229,14 @@ def generate_simple_orders_file(ctx):
 
 
 @task
-def print_tracking_numbers(ctx):
+def print_tracking_numbers(ctx, processes=None, backend='pdftotext'):
     """
     Print all tracking numbers from shipping label PDFs in current directory.
 
     """
     from trackingnumber.extractor import TrackingNumberExtractor
-    extractor = TrackingNumberExtractor('.')
+    extractor = TrackingNumberExtractor(
+        '.', processes=int(processes) if processes else None, backend=backend)
     tracking_numbers = extractor.get_tracking_numbers()
     for i, tn_list in enumerate(tracking_numbers, 1):
         print('Page {}:'.format(i))
@@ -199,11 +246,30 @@ def print_tracking_numbers(ctx):
 
 @task
 def write_packing_info_to_labels(ctx, skip_download=False,
-                                      label_count=None):
+                                      label_count=None, processes=None,
+                                      backend='pdftotext',
+                                      persistent_mapper=False,
+                                      streaming=False, chunk_size=None,
+                                      render_processes=None, dedupe=False):
     """
     Read all shipping label PDFs in current directory and output a consolidated
     shipping label PDF that contains packing information.
 
+    With --persistent-mapper, the tracking number mapper database is kept in
+    ORDERS_DIR/mapper.db, so only orders that changed are loaded on each run.
+
+    With --streaming, label PDFs are merged one file at a time to keep memory
+    use flat for large batches (requires pdfunite).
+
+    With --chunk-size N, the output is written as part files of N pages, so
+    printing can start on the first part while later parts are produced.
+
+    With --render-processes N, overlays are rendered and merged on N
+    processes (requires pdfunite unless --chunk-size is also given).
+
+    With --dedupe, fonts and images that are repeated across labels are only
+    stored once in the output, and the sizes before and after are printed.
+
     """
     if not skip_download:
         import orders
@@ -215,10 +281,44 @@ def write_packing_info_to_labels(ctx, skip_download=False,
     from packinginfo import PackingInfoWriter
     writer = PackingInfoWriter(
         label_count=label_count,
+        processes=int(processes) if processes else None,
+        backend=backend,
+        mapper_db_file=Path(config.ORDERS_DIR) / 'mapper.db'
+        if persistent_mapper else None,
+        streaming=streaming,
+        render_processes=int(render_processes) if render_processes else None,
+        dedupe=dedupe,
         # simple_orders_file='orders/shipped_orders_simple.json'
     )
     # writer.write_output_file('test+packing.pdf')
-    writer.write_output_file()
+    writer.write_output_file(
+        chunk_size=int(chunk_size) if chunk_size else None)
+
+
+@task
+def add_packing_data_to_labels(ctx, output_file='labels+packing.pdf',
+                               label_count=None, batched=False):
+    """
+    Read all shipping label PDFs in current directory and write packing
+    information onto them with the older PackingInfoAdder, which looks up
+    tracking numbers in orders/tracking_num_to_packing_info.json.
+
+    With --batched, each PDF is read with a single pdftotext call instead of
+    three cropped calls per page.
+
+    """
+    import packingdata
+    packingdata.generate_tracking_num_to_order_id_file()
+    packingdata.generate_tracking_num_to_packing_info_file()
+
+    pdf_files = sorted(
+        pdf_file for pdf_file in Path('.').glob('*.pdf')
+        if not pdf_file.stem.endswith('+packing'))
+    adder = packingdata.PackingInfoAdder(
+        pdf_files,
+        label_count=int(label_count) if label_count else None,
+        batched=batched)
+    adder.write_output_file(Path(output_file))
 
 
 @task
@@ -232,6 +332,49 @@ def download_item_location_csv(ctx):
     gsheet.download_item_location_csv()
 
 
+@task
+def bench_startup(ctx, runs=5):
+    """
+    Measure the import time of each task, to catch slow startup regressions.
+
+    """
+    import bench
+    bench.bench_startup(runs=int(runs))
+
+
+@task
+def bench_extractor_backends(ctx, runs=3):
+    """
+    Compare the speed and output of the tracking number extraction backends on
+    the shipping label PDFs in current directory.
+
+    """
+    import bench
+    bench.bench_extractor_backends('.', runs=int(runs))
+
+
+@task
+def bench_overlay_rendering(ctx, runs=3):
+    """
+    Compare the speed of rendering packing info overlays one PDF per page and
+    as a single PDF, at 50, 500 and 5000 labels.
+
+    """
+    import bench
+    bench.bench_overlay_rendering(runs=int(runs))
+
+
+@task
+def bench_page_normalization(ctx, runs=3):
+    """
+    Compare the speed and output size of the two ways of making half-size
+    shipping labels in current directory full size.
+
+    """
+    import bench
+    bench.bench_page_normalization('.', runs=int(runs))
+
+
 @task
 def web(ctx):
     """
@@ -0,0 +1,413 @@
+"""
+Backends that return the words on each page of a PDF, with their positions.
+
+"""
+import re
+
+from PyPDF2 import PdfFileReader
+from PyPDF2.pdf import ContentStream
+from reportlab.pdfbase import pdfmetrics
+
+from .extractor import TrackingNumberReadMeta, Word, get_pages_for_pdf
+
+
+class PdftotextBackend:
+    """
+    Runs the external pdftotext program on each PDF.
+
+    """
+    name = 'pdftotext'
+
+    def get_pages(self, pdf_file):
+        return get_pages_for_pdf(pdf_file)
+
+
+class PyPDF2Backend:
+    """
+    Reads word positions directly from the page content streams. A page that
+    can't be decoded, or that has no words inside any tracking number bounding
+    box, is read with pdftotext instead.
+
+    Glyphs are advanced by the widths in the font dictionary (or the standard
+    font metrics), so word positions are close to what pdftotext reports.
+
+    """
+    name = 'pypdf2'
+
+    def __init__(self):
+        # Number of pages that were read with pdftotext.
+        self.fallback_count = 0
+
+    def get_pages(self, pdf_file):
+        with open(str(pdf_file), 'rb') as fp:
+            # EBay label PDFs are a bit weird, so set strict to False.
+            reader = PdfFileReader(fp, strict=False)
+            for page_index in range(reader.numPages):
+                try:
+                    words = get_words_for_page(reader.getPage(page_index))
+                except UndecodablePage:
+                    words = None
+
+                if not words or not any(
+                        TrackingNumberReadMeta.get((word.x, word.y))
+                        for word in words):
+                    self.fallback_count += 1
+                    page_num = page_index + 1
+                    words = next(
+                        get_pages_for_pdf(pdf_file, page_num, page_num), [])
+                yield words
+
+
+BACKENDS = {
+    PdftotextBackend.name: PdftotextBackend,
+    PyPDF2Backend.name: PyPDF2Backend,
+}
+
+
+def get_backend(name):
+    return BACKENDS[name]()
+
+
+class UndecodablePage(Exception):
+    pass
+
+
+# Approximate glyph metrics, as fractions of the font size.
+ASCENT = 0.8
+DESCENT = -0.2
+# Glyph width used when the font doesn't give one.
+CHAR_WIDTH = 0.6
+# A TJ adjustment that moves the next glyph at least this far to the right (as
+# a fraction of the font size) starts a new word, like a space would.
+WORD_GAP = 0.15
+
+IDENTITY = (1, 0, 0, 1, 0, 0)
+
+
+def get_words_for_page(page):
+    """
+    Return a list of Word tuples for page, using the same coordinates as
+    pdftotext -bbox (points from the top left of the media box).
+
+    """
+    if page.get('/Rotate', 0) % 360 != 0:
+        raise UndecodablePage('Rotated pages are not supported')
+
+    contents = page.getContents()
+    if contents is None:
+        return []
+
+    resources = page['/Resources'].getObject() if '/Resources' in page else {}
+    fonts = resources.get('/Font', {})
+    fonts = fonts.getObject() if fonts else {}
+    xobjects = resources.get('/XObject', {})
+    xobjects = xobjects.getObject() if xobjects else {}
+    media_box = page.mediaBox
+    left = float(media_box.getLowerLeft_x())
+    top = float(media_box.getUpperRight_y())
+
+    words = []
+    ctm = IDENTITY
+    stack = []
+    tm = tlm = IDENTITY
+    # Text state, which q and Q save and restore along with the CTM.
+    state = TextState()
+    decoders = {}
+
+    def show(items):
+        """
+        Add the words for a list of strings and TJ adjustments, and move the
+        text matrix past them.
+
+        """
+        nonlocal tm
+        font = state.font
+        if font is None:
+            raise UndecodablePage('Text shown without a font')
+        size = state.font_size
+        scale = state.scale
+
+        # (text, left, right) for each glyph, in text space relative to tm.
+        glyphs = []
+        x = 0
+        for item in items:
+            if isinstance(item, bytes):
+                for code, text, width in font.get_glyphs(item):
+                    width = width / 1000 * size
+                    glyphs.append((text, x, x + width * scale))
+                    advance = width + state.char_spacing
+                    if code == 32 and font.code_length == 1:
+                        advance += state.word_spacing
+                    x += advance * scale
+            else:
+                shift = -item / 1000 * size * scale
+                if shift >= size * WORD_GAP:
+                    glyphs.append((' ', x, x))
+                x += shift
+
+        matrix = multiply(tm, ctm)
+        y_min = size * DESCENT + state.rise
+        y_max = size * ASCENT + state.rise
+        for word in get_glyph_words(glyphs):
+            # Transform the box of the word to page coordinates.
+            corners = [
+                apply(matrix, word_x, word_y)
+                for word_x in (word[0][1], word[-1][2])
+                for word_y in (y_min, y_max)
+            ]
+            words.append(Word(
+                min(cx for cx, cy in corners) - left,
+                top - max(cy for cx, cy in corners),
+                ''.join(text for text, _, _ in word)))
+
+        tm = multiply((1, 0, 0, 1, x, 0), tm)
+
+    for operands, operator in ContentStream(contents, page.pdf).operations:
+        if operator == b'q':
+            stack.append((ctm, state.copy()))
+        elif operator == b'Q':
+            ctm, state = stack.pop() if stack else (IDENTITY, TextState())
+        elif operator == b'cm':
+            ctm = multiply(tuple(float(n) for n in operands), ctm)
+        elif operator == b'Do':
+            name = operands[0]
+            if name not in xobjects or \
+                    xobjects[name].getObject().get('/Subtype') != '/Image':
+                # Form XObjects can show text of their own.
+                raise UndecodablePage('XObject {} drawn'.format(name))
+        elif operator == b'BT':
+            tm = tlm = IDENTITY
+        elif operator == b'Tf':
+            name, state.font_size = operands[0], float(operands[1])
+            if name not in fonts:
+                raise UndecodablePage('Unknown font {}'.format(name))
+            if name not in decoders:
+                decoders[name] = get_font_decoder(fonts[name].getObject())
+            state.font = decoders[name]
+        elif operator == b'TL':
+            state.leading = float(operands[0])
+        elif operator == b'Tc':
+            state.char_spacing = float(operands[0])
+        elif operator == b'Tw':
+            state.word_spacing = float(operands[0])
+        elif operator == b'Tz':
+            state.scale = float(operands[0]) / 100
+        elif operator == b'Ts':
+            state.rise = float(operands[0])
+        elif operator in (b'Td', b'TD'):
+            tx, ty = float(operands[0]), float(operands[1])
+            if operator == b'TD':
+                state.leading = -ty
+            tm = tlm = multiply((1, 0, 0, 1, tx, ty), tlm)
+        elif operator == b'Tm':
+            tm = tlm = tuple(float(n) for n in operands)
+        elif operator == b'T*':
+            tm = tlm = multiply((1, 0, 0, 1, 0, -state.leading), tlm)
+        elif operator == b'Tj':
+            show([operands[0].original_bytes])
+        elif operator == b'TJ':
+            show([item.original_bytes if hasattr(item, 'original_bytes')
+                  else float(item) for item in operands[0]])
+        elif operator in (b"'", b'"'):
+            if operator == b'"':
+                state.word_spacing = float(operands[0])
+                state.char_spacing = float(operands[1])
+            tm = tlm = multiply((1, 0, 0, 1, 0, -state.leading), tlm)
+            show([operands[-1].original_bytes])
+
+    return words
+
+
+class TextState:
+    "The text state parameters that get_words_for_page() keeps track of."
+    def __init__(self):
+        self.font = None
+        self.font_size = 0
+        self.leading = 0
+        self.char_spacing = 0
+        self.word_spacing = 0
+        self.scale = 1
+        self.rise = 0
+
+    def copy(self):
+        result = TextState()
+        result.__dict__.update(self.__dict__)
+        return result
+
+
+def get_glyph_words(glyphs):
+    "Split a list of (text, left, right) glyphs into lists of word glyphs."
+    word = []
+    for glyph in glyphs:
+        if glyph[0].isspace():
+            if word:
+                yield word
+            word = []
+        else:
+            word.append(glyph)
+    if word:
+        yield word
+
+
+def multiply(m1, m2):
+    "Return the product of two PDF matrices (a, b, c, d, e, f)."
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (
+        a1 * a2 + b1 * c2,
+        a1 * b2 + b1 * d2,
+        c1 * a2 + d1 * c2,
+        c1 * b2 + d1 * d2,
+        e1 * a2 + f1 * c2 + e2,
+        e1 * b2 + f1 * d2 + f2,
+    )
+
+
+def apply(matrix, x, y):
+    a, b, c, d, e, f = matrix
+    return a * x + c * y + e, b * x + d * y + f
+
+
+class FontDecoder:
+    """
+    Decodes the bytes of a shown string to glyphs. Uses the font's ToUnicode
+    CMap if it has one, and otherwise treats the font as a simple font with a
+    Latin-1 compatible encoding.
+
+    widths maps character codes to glyph widths in thousandths of the font
+    size; codes that are missing use default_width.
+
+    """
+    def __init__(self, code_length=1, cmap=None, widths=None,
+                 default_width=CHAR_WIDTH * 1000):
+        self.code_length = code_length
+        self.cmap = cmap
+        self.widths = widths or {}
+        self.default_width = default_width
+
+    def get_glyphs(self, raw):
+        "Return a list of (code, text, width) tuples for the shown bytes."
+        n = self.code_length
+        result = []
+        for i in range(0, len(raw), n):
+            code = int.from_bytes(raw[i:i+n], 'big')
+            if self.cmap is None:
+                text = chr(code)
+            else:
+                try:
+                    text = self.cmap[code]
+                except KeyError:
+                    raise UndecodablePage(
+                        'Character code missing from ToUnicode')
+
+            if any(not ch.isprintable() and not ch.isspace() for ch in text):
+                raise UndecodablePage('Undecodable text {!r}'.format(text))
+            result.append(
+                (code, text, self.widths.get(code, self.default_width)))
+        return result
+
+
+def get_font_decoder(font):
+    code_length = 2 if font.get('/Subtype') == '/Type0' else 1
+    if code_length == 1:
+        widths, default_width = get_simple_font_widths(font)
+    else:
+        widths, default_width = get_composite_font_widths(font)
+
+    if '/ToUnicode' in font:
+        cmap = parse_to_unicode(font['/ToUnicode'].getObject().getData())
+        return FontDecoder(code_length, cmap, widths, default_width)
+    if code_length != 1:
+        raise UndecodablePage('Composite font without ToUnicode')
+    return FontDecoder(widths=widths, default_width=default_width)
+
+
+def get_simple_font_widths(font):
+    """
+    Return a dict of character code -> width and the default width for a
+    simple font. The standard 14 fonts don't need to list their widths, so
+    those are taken from reportlab's metrics.
+
+    """
+    default_width = CHAR_WIDTH * 1000
+    descriptor = font['/FontDescriptor'] if '/FontDescriptor' in font else {}
+    if '/MissingWidth' in descriptor:
+        default_width = float(descriptor['/MissingWidth'])
+
+    if '/Widths' in font:
+        first_char = int(font['/FirstChar']) if '/FirstChar' in font else 0
+        return {first_char + i: float(width.getObject())
+                for i, width in enumerate(font['/Widths'])}, default_width
+
+    base_font = font.get('/BaseFont', '').lstrip('/')
+    if base_font in pdfmetrics.standardFonts:
+        metrics = pdfmetrics.getFont(base_font)
+        return {code: metrics.stringWidth(chr(code), 1000)
+                for code in range(32, 256)}, default_width
+
+    return {}, default_width
+
+
+def get_composite_font_widths(font):
+    """
+    Return a dict of character code -> width and the default width for a
+    Type0 font, from the /W array of its descendant font. This assumes an
+    Identity encoding, so that character codes are CIDs.
+
+    """
+    if '/DescendantFonts' not in font:
+        return {}, 1000
+    descendant = font['/DescendantFonts'][0].getObject()
+    default_width = float(descendant['/DW']) if '/DW' in descendant else 1000
+
+    widths = {}
+    entries = [entry.getObject() for entry in descendant['/W']] \
+        if '/W' in descendant else []
+    i = 0
+    while i + 1 < len(entries):
+        first = int(entries[i])
+        value = entries[i + 1].getObject()
+        if isinstance(value, list):
+            # first [w1 w2 ...]
+            for offset, width in enumerate(value):
+                widths[first + offset] = float(width.getObject())
+            i += 2
+        else:
+            # first last w
+            last, width = int(value), float(entries[i + 2])
+            for code in range(first, last + 1):
+                widths[code] = width
+            i += 3
+    return widths, default_width
+
+
+BFCHAR_RE = re.compile(rb'beginbfchar(.*?)endbfchar', re.S)
+BFRANGE_RE = re.compile(rb'beginbfrange(.*?)endbfrange', re.S)
+HEX_RE = re.compile(rb'<([0-9A-Fa-f]+)>')
+
+
+def parse_to_unicode(data):
+    "Return a dict of character code -> text from a ToUnicode CMap."
+    cmap = {}
+
+    def to_text(hex_bytes):
+        return bytes.fromhex(hex_bytes.decode('ascii')).decode(
+            'utf-16-be', 'replace')
+
+    for block in BFCHAR_RE.findall(data):
+        values = HEX_RE.findall(block)
+        for src, dst in zip(values[::2], values[1::2]):
+            cmap[int(src, 16)] = to_text(dst)
+
+    for block in BFRANGE_RE.findall(data):
+        for line in block.splitlines():
+            values = HEX_RE.findall(line)
+            if len(values) != 3 or b'[' in line:
+                # Ranges that map to an array of strings are not supported.
+                continue
+            start, end, dst = int(values[0], 16), int(values[1], 16), values[2]
+            base = to_text(dst)
+            for offset in range(end - start + 1):
+                cmap[start + offset] = base[:-1] + chr(ord(base[-1]) + offset)
+
+    return cmap
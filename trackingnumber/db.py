@@ -3,8 +3,16 @@ import operator
 
 
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect(':memory:')
+    def __init__(self, path=':memory:'):
+        self.conn = sqlite3.connect(str(path))
+
+    def transaction(self):
+        """
+        Return a context manager that commits on success and rolls back on
+        error. Statements run with executemany() inside it share one commit.
+
+        """
+        return self.conn
 
     def executescript(self, sql):
         cur = self.conn.cursor()
@@ -27,3 +35,16 @@ class Database:
             params = operator.itemgetter(*fields)(params)
         cur.execute(sql.format(fields=', '.join(fields)), params)
         self.conn.commit()
+
+    def executemany(self, sql, fields, rows):
+        """
+        Execute sql for each row without committing. Use inside transaction()
+        to load many rows at once.
+
+        """
+        cur = self.conn.cursor()
+        if fields:
+            rows = (operator.itemgetter(*fields)(row)
+                    if isinstance(row, dict) else row
+                    for row in rows)
+        cur.executemany(sql.format(fields=', '.join(fields)), rows)
@@ -1,7 +1,10 @@
 import subprocess
 from pathlib import Path
+import hashlib
+import json
 import re
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 import attr
 from lxml import etree
@@ -20,23 +23,92 @@ class TrackingNumberReadMeta:
     # Bounding box where tracking number is found (left, top, width, height).
     bbox = attr.ib(default=(0, 0, 0, 0))
 
+    # Size in points of the grid cells used to look up entries by point.
+    grid_size = 50
+    # (entry count, union of all bboxes, dict of grid cell -> entries), built
+    # on the first call to get() after entries change.
+    _index = None
+
     @classmethod
     def add_meta(cls, type, bbox):
         point = bbox[:2]
         cls.entries.append(TrackingNumberReadMeta(type=type, bbox=bbox))
+        cls._index = None
+
+    @classmethod
+    def get_layout_version(cls):
+        """
+        Return a short hash of the registered bounding boxes. Cached extraction
+        results are only valid for the same layout version.
+
+        """
+        layout = repr([(meta.type, tuple(meta.bbox)) for meta in cls.entries])
+        return hashlib.sha1(layout.encode('utf-8')).hexdigest()[:12]
 
     @classmethod
     def get(cls, coords):
-        for meta in cls.entries:
+        index = cls._index
+        if index is None or index[0] != len(cls.entries):
+            index = cls._index = cls._build_index()
+        _, bounds, cells = index
+
+        # Most words on a label are outside every bbox.
+        x, y = coords
+        if bounds is None or not contains(bounds, coords):
+            return None
+
+        cell = (int(x // cls.grid_size), int(y // cls.grid_size))
+        for meta in cells.get(cell, ()):
             if contains(meta.bbox, coords):
                 return meta
 
         return None
 
+    @classmethod
+    def _build_index(cls):
+        """
+        Return an index that maps each grid cell to the entries whose bboxes
+        overlap it. Each cell keeps the entries in registration order, so get()
+        returns the same entry as a linear scan would.
+
+        """
+        cells = defaultdict(list)
+        left = top = right = bottom = None
+
+        for meta in cls.entries:
+            x, y, w, h = meta.bbox
+            left = x if left is None else min(left, x)
+            top = y if top is None else min(top, y)
+            right = x + w if right is None else max(right, x + w)
+            bottom = y + h if bottom is None else max(bottom, y + h)
+
+            for col in range(int(x // cls.grid_size),
+                             int((x + w) // cls.grid_size) + 1):
+                for row in range(int(y // cls.grid_size),
+                                 int((y + h) // cls.grid_size) + 1):
+                    cells[col, row].append(meta)
+
+        if left is None:
+            bounds = None
+        else:
+            bounds = (left, top, right - left, bottom - top)
+        return len(cls.entries), bounds, dict(cells)
+
     def __repr__(self):
         return 'TrackingNumberReadMeta<{}>'.format(self.type)
 
 
+# Name of the extraction cache file in the label directory.
+CACHE_FILE = '.tracking-numbers-cache.json'
+
+XHTML_PAGE = '{http://www.w3.org/1999/xhtml}page'
+XHTML_WORD = '{http://www.w3.org/1999/xhtml}word'
+
+# A word from a PDF page. x and y are the top left corner, in points from the
+# top left corner of the page.
+Word = namedtuple('Word', 'x y text')
+
+
 TrackingNumberReadMeta.add_meta(
     type='bulk-domestic-top',
     bbox=(150, 129, 20, 140),
@@ -86,44 +158,136 @@ class TrackingNumber:
 
 
 class TrackingNumberExtractor:
-    def __init__(self, dir_path):
+    def __init__(self, dir_path, use_cache=False, processes=None,
+                 backend='pdftotext'):
+        """
+        If use_cache is True, the tracking numbers of each PDF are cached in a
+        file in dir_path, keyed by the PDF's content hash and the layout
+        version, so unchanged PDFs are not extracted again.
+
+        If processes is greater than 1, PDFs are extracted in parallel on a
+        pool of that many processes.
+
+        backend is the name of the backend that reads words from the PDFs (see
+        trackingnumber.backends).
+
+        """
         dir_path = Path(dir_path)
         self.input_files = list(self._get_input_files(dir_path))
+        self.cache_file = dir_path / CACHE_FILE if use_cache else None
+        self.processes = processes
+        self.backend = backend
 
         mesg = ', '.join(str(f) for f in self.input_files)
         print('Input files: ' + mesg)
 
     def get_tracking_numbers(self):
-        for pdf_file in self.input_files:
-            for i, page in enumerate(get_pages_for_pdf(pdf_file), 1):
-                # Yield a list of tracking numbers for each page.
-                yield list(self._get_tracking_numbers(page, str(pdf_file), i))
+        """
+        Yield a list of tracking numbers for each page, in (file, page) order.
+
+        """
+        if self.cache_file is None:
+            for pages in self._extract_files(self.input_files):
+                yield from pages
+            return
+
+        cache = self._read_cache()
+        used = {}
+        layout_version = TrackingNumberReadMeta.get_layout_version()
+
+        keys = [
+            '{}:{}:{}'.format(
+                get_file_hash(pdf_file), layout_version, self.backend)
+            for pdf_file in self.input_files
+        ]
+        missing = [pdf_file for pdf_file, key in zip(self.input_files, keys)
+                   if key not in cache]
+        extracted = dict(zip(
+            missing, (list(pages) for pages in self._extract_files(missing))))
+
+        for pdf_file, key in zip(self.input_files, keys):
+            if key in cache:
+                pages = [
+                    [TrackingNumber(type, value, str(pdf_file), i)
+                     for type, value in page]
+                    for i, page in enumerate(cache[key], 1)
+                ]
+            else:
+                pages = extracted[pdf_file]
+            used[key] = [[(tn.type, tn.value) for tn in page] for page in pages]
+            yield from pages
+
+        # Only keep entries for the current input files.
+        with self.cache_file.open('w') as fp:
+            json.dump(used, fp)
+
+    def _extract_files(self, pdf_files):
+        """
+        Yield an iterable of per-page tracking number lists for each file, in
+        the same order as pdf_files.
+
+        """
+        if self.processes is None or self.processes < 2 or len(pdf_files) < 2:
+            for pdf_file in pdf_files:
+                yield get_tracking_numbers_for_file(pdf_file, self.backend)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            yield from executor.map(
+                extract_file, pdf_files, [self.backend] * len(pdf_files))
+
+    def _read_cache(self):
+        try:
+            with self.cache_file.open() as fp:
+                return json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return {}
 
     def _get_input_files(self, dir_path):
         for pdf_file in dir_path.glob('*.pdf'):
             if not pdf_file.stem.endswith('+packing'):
                 yield pdf_file
 
-    def _get_tracking_numbers(self, page, input_file, page_number):
-        result = defaultdict(list)
 
-        for word in page.findall('word'):
-            point = self._get_point(word)
-            meta = TrackingNumberReadMeta.get(point)
-            if meta is not None:
-                result[meta.type].append(word.text)
+def extract_file(pdf_file, backend='pdftotext'):
+    """
+    Return a list of tracking number lists, one for each page of pdf_file.
+    This runs in the worker processes of TrackingNumberExtractor.
+
+    """
+    return list(get_tracking_numbers_for_file(pdf_file, backend))
+
+
+def get_tracking_numbers_for_file(pdf_file, backend='pdftotext'):
+    from .backends import get_backend
+    pages = get_backend(backend).get_pages(pdf_file)
+    for i, words in enumerate(pages, 1):
+        # Yield a list of tracking numbers for each page.
+        yield list(get_tracking_numbers_for_page(words, str(pdf_file), i))
 
-        for type, values in result.items():
-            try:
-                yield TrackingNumber(
-                    type, ''.join(values), input_file, page_number)
-            except InvalidTrackingNumber as err:
-                pass
 
-    def _get_point(self, word):
-        x = float(word.get('xMin'))
-        y = float(word.get('yMin'))
-        return x, y
+def get_tracking_numbers_for_page(words, input_file, page_number):
+    result = defaultdict(list)
+
+    for word in words:
+        meta = TrackingNumberReadMeta.get((word.x, word.y))
+        if meta is not None:
+            result[meta.type].append(word.text)
+
+    for type, values in result.items():
+        try:
+            yield TrackingNumber(
+                type, ''.join(values), input_file, page_number)
+        except InvalidTrackingNumber as err:
+            pass
+
+
+def get_file_hash(path):
+    sha = hashlib.sha1()
+    with open(str(path), 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 16), b''):
+            sha.update(block)
+    return sha.hexdigest()
 
 
 def is_domestic_tracking_number(value):
@@ -134,22 +298,37 @@ def is_foreign_tracking_number(value):
     return re.match(r'\d{22}', value) or re.match(r'[A-Z]{2}\d{9}US', value)
 
 
-
-def get_pages_for_pdf(pdf_file):
-    cmd = ['pdftotext', '-bbox', str(pdf_file), '-']
-    html = subprocess.check_output(cmd).decode('utf-8')
-    html = remove_html_namespace(html)
-    root = etree.fromstring(html)
-    return root.findall('body/doc/page')
-
-
-def remove_html_namespace(html):
+def get_pages_for_pdf(pdf_file, first_page=None, last_page=None):
     """
-    Removing the namespace from the HTML will us to use xpath selectors more
-    easily in lxml.etree.
+    Yield a list of Word tuples for each page of pdf_file. The output of
+    pdftotext is parsed as it arrives, and each page is yielded (and then
+    freed) as soon as its closing tag has been read.
 
     """
-    return html.replace('xmlns="http://www.w3.org/1999/xhtml"', '')
+    cmd = ['pdftotext', '-bbox']
+    if first_page is not None:
+        cmd += ['-f', str(first_page)]
+    if last_page is not None:
+        cmd += ['-l', str(last_page)]
+    cmd += [str(pdf_file), '-']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        for _, page in etree.iterparse(proc.stdout, tag=XHTML_PAGE):
+            yield [
+                Word(float(word.get('xMin')), float(word.get('yMin')),
+                     word.text)
+                for word in page.iterchildren(XHTML_WORD)
+            ]
+            # Free the page and any siblings that came before it.
+            page.clear()
+            while page.getprevious() is not None:
+                del page.getparent()[0]
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
 
 
 def contains(bbox, point):
@@ -1,6 +1,12 @@
+import hashlib
 import json
+from collections import OrderedDict, defaultdict
 
-from orders import download_shipped_orders, load_orders
+import config
+import util
+from orders import (
+    download_shipped_orders, load_orders, get_items,
+    get_tracking_numbers_for_order)
 
 from .db import Database
 
@@ -9,82 +15,309 @@ class TrackingNumberMapper:
     """
     Maps tracking numbers to output info.
 
+    If indexed is True, orders are kept in dicts keyed by tracking number and
+    by buyer instead of in a SQL database, so each lookup takes constant time.
+    The output is the same either way.
+
     """
-    def __init__(self, simple_orders_file=None):
-        self.db = Database()
-        self.db.executescript("""
-        create table orders(
-            order_id text,
-            packing_info text,
-            username text,
-            buyer text
-        );
-        create table order_tracking(
-            order_id text,
-            tracking_number text,
-            primary key(order_id, tracking_number)
-        );
-        """)
+    def __init__(self, simple_orders_file=None, indexed=False, db_file=None,
+                 use_store=None):
+        """
+        If db_file is given, the SQL database is kept in that file between
+        runs, and only orders that changed since the last load are written.
+
+        If use_store is True (default: config.USE_ORDER_STORE, unless
+        simple_orders_file is given), nothing is loaded up front, and each
+        lookup queries the shipped orders in the order store instead.
+
+        """
+        if use_store is None:
+            use_store = config.USE_ORDER_STORE and simple_orders_file is None
+        self.indexed = indexed
+        self.store = None
+        if use_store:
+            from orderstore import OrderStore
+            self.store = OrderStore()
+            return
+
+        if indexed:
+            self.orders_by_tracking_number = defaultdict(list)
+            # Orders without tracking numbers, keyed by buyer.
+            self.untracked_orders_by_buyer = defaultdict(list)
+        else:
+            self.db = Database(db_file or ':memory:')
+            self.db.executescript("""
+            create table if not exists orders(
+                order_id text primary key,
+                packing_info text,
+                username text,
+                buyer text,
+                digest text,
+                position integer
+            );
+            create table if not exists order_tracking(
+                order_id text,
+                tracking_number text,
+                primary key(order_id, tracking_number)
+            );
+            create index if not exists orders_buyer on orders(buyer);
+            create index if not exists order_tracking_number
+                on order_tracking(tracking_number);
+            create index if not exists order_tracking_order_id
+                on order_tracking(order_id);
+            """)
+            columns = [row[1] for row in
+                       self.db.select('pragma table_info(orders)')]
+            if 'position' not in columns:
+                # A database file written before positions were stored.
+                self.db.executescript(
+                    'alter table orders add column position integer')
 
         if simple_orders_file is None:
             orders = get_simple_orders()
         else:
             orders = json.load(open(simple_orders_file))
 
-        self.add_orders(orders)
+        if indexed:
+            self.add_orders(orders)
+        else:
+            self._sync_orders(orders)
 
     def add_orders(self, orders):
+        """
+        Add orders after the existing orders, replacing any existing orders
+        with the same order IDs. All rows are written in a single transaction.
+
+        """
+        if self.indexed:
+            self._index_orders(orders)
+            return
+
+        orders = list(orders)
+        (start,), = self.db.select(
+            'select coalesce(max(position) + 1, 0) from orders')
+        self._write_orders(orders, range(start, start + len(orders)))
+
+    def _write_orders(self, orders, positions):
+        """
+        Insert or replace orders, giving each the corresponding position.
+        Lookups return orders sorted by position, so that they come out in the
+        order they were loaded in.
+
+        """
+        order_ids = [(order['order_id'],) for order in orders]
+
+        with self.db.transaction():
+            self.db.executemany(
+                'delete from order_tracking where order_id = ?', (), order_ids)
+            self.db.executemany(
+                'insert or replace into orders ({fields}) '
+                'values (?, ?, ?, ?, ?, ?)',
+                ['order_id', 'packing_info', 'username', 'buyer', 'digest',
+                 'position'],
+                (dict(order, digest=get_digest(order), position=position)
+                 for order, position in zip(orders, positions)))
+            self.db.executemany(
+                'insert or ignore into order_tracking ({fields}) '
+                'values (?, ?)',
+                ['order_id', 'tracking_number'],
+                ((order['order_id'], tn)
+                 for order in orders for tn in order['tracking_numbers']))
+
+    def _sync_orders(self, orders):
+        """
+        Make the database contain exactly the given orders, in the given
+        order, only writing the orders that are new or have changed since the
+        last load. Unchanged orders that moved only get their position
+        updated.
+
+        """
+        existing = {
+            order_id: (digest, position)
+            for order_id, digest, position in self.db.select(
+                'select order_id, digest, position from orders')}
+        current_ids = set(order['order_id'] for order in orders)
+        removed = [(order_id,) for order_id in existing
+                   if order_id not in current_ids]
+        changed = []
+        changed_positions = []
+        moved = []
+        for position, order in enumerate(orders):
+            digest, old_position = existing.get(
+                order['order_id'], (None, None))
+            if digest != get_digest(order):
+                changed.append(order)
+                changed_positions.append(position)
+            elif old_position != position:
+                moved.append((position, order['order_id']))
+
+        with self.db.transaction():
+            self.db.executemany(
+                'delete from orders where order_id = ?', (), removed)
+            self.db.executemany(
+                'delete from order_tracking where order_id = ?', (), removed)
+            self.db.executemany(
+                'update orders set position = ? where order_id = ?', (),
+                moved)
+        self._write_orders(changed, changed_positions)
+        print('Mapper database: {} orders changed, {} moved, {} removed'
+              .format(len(changed), len(moved), len(removed)))
+
+    def _index_orders(self, orders):
         for order in orders:
-            self.db.execute(
-                'insert into orders ({fields}) values (?, ?, ?, ?)',
-                ['order_id', 'packing_info', 'username', 'buyer'],
-                order)
-
-            for tracking_num in order['tracking_numbers']:
-                try:
-                    self.db.execute(
-                        'insert into order_tracking ({fields}) values (?, ?)',
-                        ['order_id', 'tracking_number'],
-                        [order['order_id'], tracking_num])
-                except Exception as ex:
-                    print(ex)
-                    import ipdb; ipdb.set_trace()
+            row = dict(
+                order_id=order['order_id'],
+                packing_info=order['packing_info'],
+                username=order['username'],
+                buyer=order['buyer'])
+
+            if not order['tracking_numbers']:
+                self.untracked_orders_by_buyer[row['buyer']].append(row)
+            # Orders are appended in insertion order, which is the order the
+            # SQL query returns them in.
+            for tracking_num in set(order['tracking_numbers']):
+                self.orders_by_tracking_number[tracking_num].append(row)
 
     def get_output(self, tracking_number):
-        orders = self.db.select("""
-            select {fields} from orders
-            where order_id in (select order_id from order_tracking
-                               where tracking_number = ?)""",
-            ['order_id', 'packing_info', 'username', 'buyer'],
-            tracking_number)
-
-        if not orders:
-            return None            
-
-        return dict(
-            packing_info='; '.join(o['packing_info'] for o in orders),
-            username=orders[0]['username'],
-            notes=self._get_notes(orders))
-
-    def _get_notes(self, orders):
-        buyer = orders[0]['buyer']
-        other_orders = self.db.select("""
-            select packing_info from orders
-            where buyer = ?
-            and order_id not in (select order_id from order_tracking)""",
-            (),
-            buyer)
-
-        if other_orders:
-            stuff = '; '.join(r[0] for r in other_orders)
-            return 'Buyer {buyer} also bought {stuff}'.format(
-                buyer=buyer, stuff=stuff)
+        return self.get_outputs([tracking_number]).get(tracking_number)
+
+    def get_outputs(self, tracking_numbers):
+        """
+        Return a dict of tracking number -> output for all of the given
+        tracking numbers, resolved in one pass over the index (or a few
+        queries). Tracking numbers with no linked orders are left out.
+
+        """
+        tracking_numbers = list(OrderedDict.fromkeys(tracking_numbers))
+        if self.store is not None:
+            orders_by_tracking_number = self._query_store_orders(
+                tracking_numbers)
+        elif self.indexed:
+            orders_by_tracking_number = {
+                tn: self.orders_by_tracking_number[tn]
+                for tn in tracking_numbers
+                if tn in self.orders_by_tracking_number}
         else:
-            return None
+            orders_by_tracking_number = self._select_orders(tracking_numbers)
+
+        buyers = set(orders[0]['buyer']
+                     for orders in orders_by_tracking_number.values())
+        if self.store is not None:
+            other_orders_by_buyer = self._query_store_other_orders(buyers)
+        elif self.indexed:
+            other_orders_by_buyer = {
+                buyer: [o['packing_info']
+                        for o in self.untracked_orders_by_buyer.get(buyer, ())]
+                for buyer in buyers}
+        else:
+            other_orders_by_buyer = self._select_other_orders(buyers)
+
+        result = {}
+        for tn, orders in orders_by_tracking_number.items():
+            buyer = orders[0]['buyer']
+            result[tn] = dict(
+                packing_info='; '.join(o['packing_info'] for o in orders),
+                username=orders[0]['username'],
+                notes=get_notes(buyer, other_orders_by_buyer.get(buyer)))
+        return result
+
+    def _query_store_orders(self, tracking_numbers):
+        result = {}
+        for tn in tracking_numbers:
+            orders = self.store.get_orders_for_tracking_number(
+                tn, source=SHIPPED_SOURCE)
+            if orders:
+                result[tn] = [get_simple_order(o) for o in orders]
+        return result
+
+    def _query_store_other_orders(self, buyers):
+        "Return a dict of buyer -> packing info of orders without tracking."
+        result = {}
+        for buyer in buyers:
+            orders = self.store.get_orders(SHIPPED_SOURCE, buyer=buyer)
+            result[buyer] = [
+                get_simple_order(o)['packing_info'] for o in orders
+                if not get_tracking_numbers_for_order(o)]
+        return result
+
+    def _select_orders(self, tracking_numbers):
+        result = defaultdict(list)
+        for chunk in get_chunks(tracking_numbers):
+            rows = self.db.select("""
+                select t.tracking_number, o.order_id, o.packing_info,
+                       o.username, o.buyer
+                from order_tracking t join orders o on o.order_id = t.order_id
+                where t.tracking_number in ({})
+                order by o.position""".format(', '.join('?' * len(chunk))),
+                (),
+                *chunk)
+            for tn, order_id, packing_info, username, buyer in rows:
+                result[tn].append(dict(
+                    order_id=order_id, packing_info=packing_info,
+                    username=username, buyer=buyer))
+        return result
+
+    def _select_other_orders(self, buyers):
+        "Return a dict of buyer -> packing info of orders without tracking."
+        result = defaultdict(list)
+        for chunk in get_chunks(list(buyers)):
+            rows = self.db.select("""
+                select buyer, packing_info from orders
+                where buyer in ({})
+                and order_id not in (select order_id from order_tracking)
+                order by position""".format(', '.join('?' * len(chunk))),
+                (),
+                *chunk)
+            for buyer, packing_info in rows:
+                result[buyer].append(packing_info)
+        return result
+
+
+def get_notes(buyer, other_orders):
+    if other_orders:
+        stuff = '; '.join(other_orders)
+        return 'Buyer {buyer} also bought {stuff}'.format(
+            buyer=buyer, stuff=stuff)
+    else:
+        return None
+
+
+# The order store source that shipped orders are read from.
+SHIPPED_SOURCE = 'shipped_orders.json'
+
+# Maximum number of parameters in each "in (...)" query. SQLite's default
+# limit is 999.
+CHUNK_SIZE = 500
+
+
+def get_chunks(values, size=CHUNK_SIZE):
+    for i in range(0, len(values), size):
+        yield values[i:i+size]
+
+
+def get_digest(order):
+    "Return a hash of the fields of a simple order."
+    fields = [order['packing_info'], order['username'], order['buyer'],
+              sorted(order['tracking_numbers'])]
+    return hashlib.sha1(json.dumps(fields).encode('utf-8')).hexdigest()
+
+
+def get_simple_order(order):
+    "Return the simple order for an order from the order store."
+    order = dict(order, items=list(get_items(order)))
+    return dict(
+        order_id=order['OrderID'],
+        packing_info=util.get_packing_info(order),
+        username=order['username'],
+        buyer=order['BuyerUserID'],
+        tracking_numbers=list(get_tracking_numbers_for_order(order)),
+    )
 
 
 def get_shipped_orders():
-    for user, orders in load_orders('shipped_orders.json')['payload'].items():
+    # Only a few fields are read, so don't compute the others.
+    download = load_orders(SHIPPED_SOURCE, lazy=True)
+    for user, orders in download['payload'].items():
         for order in orders:
             yield order
 
@@ -106,23 +339,3 @@ def generate_simple_orders_file():
     with open('orders/shipped_orders_simple.json', 'w') as fp:
         result = get_simple_orders()
         json.dump(result, fp, indent=2)
-
-
-def get_tracking_numbers_for_order(order):
-    tracking_nums = set()
-
-    transactions = order['TransactionArray']['Transaction']
-    for transaction in transactions:
-        try:
-            details = transaction['ShippingDetails']['ShipmentTrackingDetails']
-        except KeyError:
-            details = []
-
-        if not isinstance(details, list):
-            details = [details]
-
-        for detail in details:
-            tn = detail['ShipmentTrackingNumber']
-            tracking_nums.add(tn)
-
-    return tracking_nums
@@ -1,27 +1,36 @@
 from pathlib import Path
 from pprint import pprint
+from datetime import datetime, timezone
 import csv
+import functools
 import json
-
-import arrow
-import requests
-from mako.template import Template
-from mako.lookup import TemplateLookup
-from plim import preprocessor
-import boto3
+import re
+import threading
+import time
 
 import config
 
+# Heavy third-party modules (arrow, requests, mako, plim, boto3) are imported
+# inside the functions that use them, so that importing this module is cheap.
+
 
 here = Path(__file__).parent
+# The CSV files that item metadata is read from.
+ITEM_CSV_FILES = ('item_location.csv', 'item_model.csv')
 template_dir = here / 'templates'
-lookup = TemplateLookup(
-    directories=[str(template_dir)],
-    preprocessor=preprocessor)
+
+
+@functools.lru_cache()
+def get_lookup():
+    from mako.lookup import TemplateLookup
+    from plim import preprocessor
+    return TemplateLookup(
+        directories=[str(template_dir)],
+        preprocessor=preprocessor)
 
 
 def render(filename, **kwargs):
-    tmpl = lookup.get_template(filename)
+    tmpl = get_lookup().get_template(filename)
     return tmpl.render(**kwargs)
 
 
@@ -31,6 +40,8 @@ def render_to_file(output_file, template_file, **kwargs):
 
 
 def send_email(recipient, subject, body):
+    import requests
+
     domain, private_key = config.MAILGUN_PARAMS.split(';')
     url = 'https://api.mailgun.net/v3/{}/messages'.format(domain)
 
@@ -48,6 +59,8 @@ def send_email(recipient, subject, body):
 
 
 def send_sms(number, message):
+    import boto3
+
     access_key, secret_key = config.AWS_PARAMS.split(';')
     client = boto3.client(
         'sns',
@@ -68,34 +81,152 @@ def send_sms(number, message):
 
 
 def local_now():
+    import arrow
     return arrow.utcnow().to(config.TIME_ZONE)
 
 
-def str_to_local_time(text):
-    return arrow.get(text).to(config.TIME_ZONE)
+# Timestamps returned by the eBay API, e.g. 2017-06-01T21:04:33.000Z
+EBAY_TIME_RE = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?Z$')
 
 
-def get_item_metadata_map():
+@functools.lru_cache()
+def get_local_tzinfo():
+    from dateutil import tz as dateutil_tz
+    return dateutil_tz.gettz(config.TIME_ZONE)
+
+
+def str_to_local_time(text, tzinfo=None):
+    """
+    Convert a timestamp string to an Arrow object in config.TIME_ZONE. eBay's
+    fixed ISO 8601 format is parsed directly; anything else goes through
+    arrow.get(). tzinfo can be given to skip looking up the time zone.
+
+    """
+    import arrow
+
+    match = EBAY_TIME_RE.match(text) if isinstance(text, str) else None
+    if match is None:
+        return arrow.get(text).to(config.TIME_ZONE)
+
+    year, month, day, hour, minute, second, fraction = match.groups()
+    microsecond = int(fraction.ljust(6, '0')) if fraction else 0
+    dt = datetime(
+        int(year), int(month), int(day), int(hour), int(minute), int(second),
+        microsecond, tzinfo=timezone.utc)
+    if tzinfo is None:
+        tzinfo = get_local_tzinfo()
+    return arrow.Arrow.fromdatetime(dt.astimezone(tzinfo))
+
+
+def strs_to_local_times(texts):
+    """
+    Convert a sequence of timestamp strings with str_to_local_time(). The time
+    zone is looked up once, and each distinct string is only parsed once.
+
+    """
+    tzinfo = get_local_tzinfo()
+    cache = {}
+    result = []
+    for text in texts:
+        value = cache.get(text)
+        if value is None:
+            value = cache[text] = str_to_local_time(text, tzinfo)
+        result.append(value)
+    return result
+
+
+def get_item_metadata_map(csv_file=here / 'item_location.csv'):
     """
     Return a dict where the keys are models and the values are dicts.
 
     """
     result = {}
-    with (here / 'item_location.csv').open() as fp:
+    with csv_file.open() as fp:
         for row in csv.DictReader(fp):
             model = row['Model'].lower()
             result[model] = row
 
     return result
 
-try:
-    item_metadata_map = get_item_metadata_map()
-except FileNotFoundError:
-    pass
+
+def get_item_model_map(csv_file=here / 'item_model.csv'):
+    result = {}
+    with csv_file.open() as fp:
+        for row in csv.DictReader(fp):
+            item_id = row['item_id']
+            result[item_id] = row['model']
+    return result
+
+
+class ItemIndex:
+    """
+    Item metadata from item_location.csv and item_model.csv. The CSV files are
+    read on first use, and are read again when their modification times or
+    sizes change. A missing file gives an empty map.
+
+    """
+    # Minimum number of seconds between checks of the CSV files.
+    check_interval = 1.0
+
+    def __init__(self, directory=here):
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+        # Set to -inf so that the first call always checks the files, even if
+        # another thread has already published _state.
+        self._last_check = float('-inf')
+        # (stats, metadata map, model map), replaced as a whole on reload.
+        self._state = None
+
+    @property
+    def metadata_map(self):
+        return self._get_state()[1]
+
+    @property
+    def model_map(self):
+        return self._get_state()[2]
+
+    def _get_state(self):
+        state = self._state
+        now = time.monotonic()
+        if state is not None and now - self._last_check < self.check_interval:
+            return state
+
+        stats = self._get_stats()
+        if state is None or state[0] != stats:
+            with self._lock:
+                state = self._state
+                if state is None or state[0] != stats:
+                    state = (stats, self._load(get_item_metadata_map, 0),
+                             self._load(get_item_model_map, 1))
+                    self._state = state
+
+        self._last_check = now
+        return state
+
+    def _get_stats(self):
+        stats = []
+        for name in ITEM_CSV_FILES:
+            try:
+                stat = (self.directory / name).stat()
+            except FileNotFoundError:
+                stats.append(None)
+            else:
+                stats.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(stats)
+
+    def _load(self, func, index):
+        try:
+            return func(self.directory / ITEM_CSV_FILES[index])
+        except FileNotFoundError:
+            return {}
+
+
+item_index = ItemIndex()
 
 
 def get_location_for_model(model):
-    map = item_metadata_map.get(model)
+    map = item_index.metadata_map.get(model)
     if map is None:
         return None
     else:
@@ -103,26 +234,12 @@ def get_location_for_model(model):
 
 
 def get_notes_for_item(model):
-    d = item_metadata_map.get(model)
+    d = item_index.metadata_map.get(model)
     return d['Notes'] if d else None
 
 
-def get_item_model_map():
-    result = {}
-    with (here / 'item_model.csv').open() as fp:
-        for row in csv.DictReader(fp):
-            item_id = row['item_id']
-            result[item_id] = row['model']
-    return result
-
-try:
-    item_model_map = get_item_model_map()
-except FileNotFoundError:
-    pass
-
-
 def get_model_for_item(item_id):
-    return item_model_map.get(item_id, '?')
+    return item_index.model_map.get(item_id, '?')
 
 
 def get_weight_from_model(model):
@@ -164,7 +281,7 @@ def get_packing_info(order):
         else:
             text = item['model']
 
-        meta = item_metadata_map.get(item['model'], {'Location': '_'})
+        meta = item_index.metadata_map.get(item['model'], {'Location': '_'})
         text += ' ' + meta['Location']
         result.append(text)
 
@@ -26,7 +26,7 @@ app = Flask(__name__)
 @app.route('/')
 def home():
     import orders
-    pkg = orders.load_orders('orders.json')
+    pkg = orders.load_orders('orders.json', snapshot=True)
 
     # Count the number of orders for each seller.
     seller_order_counts = OrderedDict()
@@ -58,13 +58,8 @@ def home():
 @app.route('/orders/<user>/')
 def orders_for_user(user):
     from orders import load_orders
-    pkg = load_orders('orders.json')
-
-    orders = None
-    for user_, orders_ in pkg['payload'].items():
-        if user == user_:
-            orders = orders_
-            break
+    pkg = load_orders('orders.json', username=user, snapshot=True)
+    orders = pkg['payload'][user]
 
     orders.sort(key=lambda x: x['PaidTime'])
     return render_template(